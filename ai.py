@@ -1,5 +1,8 @@
 import queue
 import pygame
+import numpy as np
+
+import stateSync
 
 AIS = 1
 
@@ -32,6 +35,7 @@ class AI():
         self.pWorthDict = dict()
         self.cDict = dict()
         self.pAttackList = set()
+        self.stateReceiver = stateSync.StateReceiver()
 
     def send(self, msg):
         self.sendFn(msg, self.team)
@@ -61,8 +65,9 @@ class AI():
     def serverUpdate(self, package):
         if package is None: return
         pkType, *pk = package
-        if pkType == 'gd':
-            cPk, pPk = pk
+        if pkType == 'gk' or pkType == 'gp':
+            tick, cPk, pPk = self.stateReceiver.receive(pkType, pk)
+            self.send(('ak', tick))
             self.cDict.clear()
             for cName in cPk:
                 team, dest, s = cPk[cName]
@@ -137,20 +142,25 @@ class AI():
                 if c.destName != pToAttack:
                     self.send(('oc', cName, pToAttack))
 
+    def update(self):
+        """Handles one message from the server and acts when it is time
+        to. Called fps times a second."""
+        if self.gaming:
+            self.serverUpdate(self.recvFn(self.team))
+            self.actionCounter -= 1
+            if self.actionCounter <= 0:
+                self.act()
+                self.actionCounter = self.fps // MOVERATE
+        else:
+            self.preGameUpdate(self.recvFn(self.team))
+
     def run(self):
 
         self.running = True
 
         while self.running:
 
-            if self.gaming:
-                self.serverUpdate(self.recvFn(self.team))
-                self.actionCounter -= 1
-                if self.actionCounter <= 0:
-                    self.act()
-                    self.actionCounter = self.fps // MOVERATE
-            else:
-                self.preGameUpdate(self.recvFn(self.team))
+            self.update()
 
             self.clock.tick(self.fps)
 
@@ -178,9 +188,9 @@ class AI_Cluster():
 
     def avgDistFrom(self, p):
         if len(self.ships) == 0: return 0
-        return (sum((norm(p.loc, loc) for loc, angle in self.ships))
-                / len(self.ships)
-                )
+        x, y = p.loc
+        return float(np.hypot(self.ships[:, 0] - x,
+                              self.ships[:, 1] - y).mean())
 
 def runAI(serverBridge):
     a = AI(serverBridge.sendMsg, serverBridge.AIGetMsg)
@@ -188,13 +198,14 @@ def runAI(serverBridge):
 
 class FakeServerBridge():
 
-    def __init__(self):
+    def __init__(self, ais=AIS, player=True):
         self.serverQ = queue.Queue()
         self.pQList = []
-        self.pQList.append(queue.Queue()) # the player queue is queue 0
+        if player:
+            self.pQList.append(queue.Queue()) # the player queue is queue 0
         self.AITeamsToAssign = []
-        for p in range(AIS):
-            self.AITeamsToAssign.append(p + 1)
+        for p in range(ais):
+            self.AITeamsToAssign.append(len(self.pQList))
             self.pQList.append(queue.Queue())
 
     def serverSendMsg(self, msg, pNo=-1):
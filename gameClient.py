@@ -2,6 +2,7 @@ import networkClient as net
 import gameServerSide
 import pgen
 import ai
+import stateSync
 
 import threading
 
@@ -288,6 +289,7 @@ class Menu():
         self.textBoxActive = None
         self.bg = pg.Surface((w, h))
         self.bg.fill((0, 0, 0))
+        self.dirtyRects = [] # parts of bg to draw again
 
     def starBG(self):
         self.bg = pgen.genStarBG(self.w, self.h)
@@ -324,6 +326,14 @@ class Menu():
             dims = tuple(map(int, dims))
             self.bg.blit(tf.scale(img, dims), loc)
 
+    def addMipImage(self, mips, loc, dims):
+        """Draws the level of a mip chain nearest to dims, centred in the
+        dims box at loc, instead of scaling the full image."""
+        img = pgen.nearestMip(mips, min(dims))
+        w, h = img.get_size()
+        self.bg.blit(img, (int(loc[0] + (dims[0] - w) / 2),
+                           int(loc[1] + (dims[1] - h) / 2)))
+
     def addMultilineLabel(self, *args, **kwargs):
         mlLabel = MultilineLabel(*args, **kwargs)
         self.bg.blit(mlLabel.image, mlLabel.rect)
@@ -377,8 +387,11 @@ class Menu():
                 self.textBoxActive.addText(event.unicode)
 
     def redraw(self, screen):
+        for rect in self.dirtyRects:
+            screen.blit(self.bg, rect, rect)
+        rects, self.dirtyRects = self.dirtyRects, []
         self.statusBoxes.clear(screen, self.bg)
-        rects = self.buttons.draw(screen)
+        rects += self.buttons.draw(screen)
         rects += self.statusBoxes.draw(screen)
         return rects
 
@@ -775,7 +788,10 @@ class PreGameMenu(Menu):
                 self.map = Map(w, h, players)
             elif t == 'p':
                 self.map.addPlanet(*contents)
+            elif t == 'pi':
+                self.map.refineImage(*contents)
         if self.map and len(self.map) == self.numPlanets:
+            self.map.packImages()
             self.downloadingMap = False
             self.serverBridge.sendMsg('ready')
             self.updateStatusBox("status", "Waiting for other players...")
@@ -786,6 +802,8 @@ class PreGameMenu(Menu):
         if msg == 'ready':
             self.waiting = False
             self.contFn(self.map, self.teamNo)
+        elif isinstance(msg, tuple) and msg[0] == 'pi':
+            self.map.refineImage(*msg[1:])
 
 class GameUI():
 
@@ -815,7 +833,7 @@ class GameUI():
         msg = self.serverBridge.getMsg()
         if msg is not None:
             pkType, *pk = msg
-            if pkType == 'gd':
+            if pkType == 'gk' or pkType == 'gp':
                 self.game.handleServerMsg(pkType, pk)
                 self.sb.refresh()
             elif pkType == 'gs':
@@ -829,6 +847,10 @@ class GameUI():
                 self.endGame()
             elif pkType == 'exit':
                 self.sb.handleServerMsg(pkType, pk)
+            elif pkType == 'pi':
+                p = self.game.map.refineImage(*pk)
+                self.game.refreshPlanet(p)
+                self.sb.refreshPlanet(p)
 
     def mouseMove(self, event):
         self.sb.mouseMove(event)
@@ -945,9 +967,11 @@ class Sidebar(Menu):
         hPerP = ((pEnd - pStart) * h) / (numP + 1) - pMarginY
         self.addLabel('PLANETS', x + w // 2, pStart * h,
                       font=Sidebar.HEADERFONT, anchor='N')
+        self.pSlots = dict()
         for i, p in enumerate(self.gameMap):
             top = (i + 1) * (hPerP + pMarginY) + (pStart * h)
-            self.addImage(p.image, (x, top), (hPerP, hPerP))
+            self.pSlots[p.name] = (x, top), (hPerP, hPerP)
+            self.addMipImage(p.mips, (x, top), (hPerP, hPerP))
             self.addStatusBox(p.name, p.name, x + hPerP + pMarginX,
                               top + (hPerP // 2), anchor='W',
                               font=Sidebar.TEXTFONT)
@@ -1033,6 +1057,14 @@ class Sidebar(Menu):
         self.textBoxActive = None
         self.textBoxDict['chat'].clearText()
 
+    def refreshPlanet(self, p):
+        """Draws the image of p again, after it has been refined."""
+        loc, dims = self.pSlots[p.name]
+        rect = pg.Rect(loc, dims)
+        self.bg.fill((0, 0, 0), rect)
+        self.addMipImage(p.mips, loc, dims)
+        self.dirtyRects.append(rect)
+
     def refreshChat(self):
         for (pNo, msg), line in zip(self.chatHist,
                                     reversed(range(Sidebar.CH_LINES))):
@@ -1074,12 +1106,15 @@ class Game():
         self.map = gameMap
         # self.bg = pg.Surface((self.map.w, self.map.h))
         # self.bg.fill((0, 0, 0))
-        self.bg = pgen.genStarBG(self.map.w, self.map.h)
+        self.stars = pgen.genStarBG(self.map.w, self.map.h)
+        self.bg = self.stars.copy()
         self.map.draw(self.bg)
+        self.dirtyRects = []
 
         # make ship containers
         self.ships = sp.RenderUpdates()
         self.clusterNames = dict()
+        self.stateReceiver = stateSync.StateReceiver()
 
         self.selected = False
 
@@ -1094,8 +1129,9 @@ class Game():
             self.clusterNames.pop(i)
 
     def handleServerMsg(self, pkType, pk):
-        if pkType == 'gd': # game data
-            cDict, pDict = pk
+        if pkType == 'gk' or pkType == 'gp': # game data, whole or changes
+            tick, cDict, pDict = self.stateReceiver.receive(pkType, pk)
+            self.serverBridge.sendMsg(('ak', tick))
 
             # do stuff with package
             for pName in pDict:
@@ -1147,12 +1183,21 @@ class Game():
                         self.selected = False
                         break
 
+    def refreshPlanet(self, p):
+        """Draws the image of p again, after it has been refined."""
+        self.bg.blit(self.stars, p.rect, p.rect)
+        self.bg.blit(p.image, p.rect)
+        self.dirtyRects.append(p.rect)
+
     def redraw(self, sc):
+        for rect in self.dirtyRects:
+            sc.blit(self.bg, rect, rect)
+        dirtyRects, self.dirtyRects = self.dirtyRects, []
         self.ships.clear(sc, self.bg)
         self.map.pTexts.clear(sc, self.bg)
         shipRects = self.ships.draw(sc)
         textRects = self.map.pTexts.draw(sc)
-        return shipRects + textRects
+        return dirtyRects + shipRects + textRects
 
 class Map(sp.Group):
 
@@ -1162,10 +1207,31 @@ class Map(sp.Group):
         self.players = players
         self.pTexts = sp.RenderUpdates()
         self.pNameDict = dict()
+        self.atlas = None
 
     def addPlanet(self, location, r, img, name=None):
         self.pNameDict[name] = Planet(self, location, r, img, name)
 
+    def refineImage(self, name, img):
+        """Replaces the placeholder image of the planet called name with the
+        RGBA string img. Returns the planet."""
+        p = self.pNameDict[name]
+        p.setImage(img)
+        return p
+
+    def packImages(self):
+        """Moves the planet images and their mip chains into one atlas. Each
+        planet keeps subsurfaces of it as its image and mips."""
+        planets = self.sprites()
+        chains = [pgen.genMipChain(p.image) for p in planets]
+        self.atlas, rects = pgen.packAtlas([img for chain in chains
+                                            for img in chain])
+        for i, p in enumerate(planets):
+            levels = len(chains[i])
+            p.mips = [self.atlas.subsurface(rect)
+                      for rect in rects[i * levels:(i + 1) * levels]]
+            p.image = p.mips[0]
+
 class Planet(sp.Sprite):
 
     def __init__(self, gameMap, location, r, img, name=None):
@@ -1183,6 +1249,13 @@ class Planet(sp.Sprite):
         # create the image
         self.image = pgi.fromstring(img, (self.r * 2 + 1, self.r * 2 + 1),
                                           'RGBA')
+        self.mips = [self.image] # the full mip chain is made by packImages
+
+    def setImage(self, img):
+        """Copies the RGBA string img over the image and its mips."""
+        image = pgi.fromstring(img, self.image.get_size(), 'RGBA')
+        for mip, level in zip(self.mips, pgen.genMipChain(image)):
+            pgen.copyImage(mip, level)
 
     def serverUpdate(self, teamNo, numUnits):
         if self.teamNo != teamNo or self.units.count != numUnits:
@@ -1268,8 +1341,8 @@ class Cluster(sp.RenderUpdates):
             self.dest = dest
         for unit in self:
             unit.kill()
-        for s in ships:
-            Ship(teamNo, *s, self, game.ships)
+        for x, y, angle in ships.tolist():
+            Ship(teamNo, (x, y), angle, self, game.ships)
 
 class Ship(sp.DirtySprite):
 
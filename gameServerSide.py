@@ -1,13 +1,23 @@
-import pgen
 import nameGen
+import texCache
+import stateSync
 
 import pygame as pg
 import pygame.time as pgtime
 import pygame.sprite as sp
 import pygame.image as pgi
 import math
+import time
+import itertools
 from math import pi
 import random as rnd
+import numpy as np
+from concurrent import futures
+
+MAP_WORKERS = 0 # processes generating planet images, 0 to use this one
+# start games with placeholder planets and send the real images as they are
+# generated
+PROGRESSIVE_MAPS = True
 
 def normalise(angle):
     return (angle + pi) % (2 * pi) - pi
@@ -42,6 +52,15 @@ def norm(pt1, pt2):
     x2, y2 = pt2
     return ((x1 - x2) ** 2 + (y1- y2) ** 2) ** 0.5
 
+def randNormalCutoff(a, b, dev, rng):
+    """Draws from rng as pgen.randNormalCutoff does, so that placing
+    planets does not need pgen."""
+    if a > b: a, b = b, a
+    delta = rng.gauss(0, b - a / dev)
+    if abs(delta) > (b - a) / 2:
+        return rng.random() * (b - a) + a
+    return (a + b) / 2 + delta
+
 class RectSp(sp.Sprite):
     # this is a dummy rectangle sprite
     def __init__(self, rect):
@@ -49,34 +68,65 @@ class RectSp(sp.Sprite):
         self.rect = rect
 
 class GameServer():
-
-    def __init__(self, w, h, players, sendFn, recvFn):
+    """Runs a game at its frame rate. With fastForward, ticks follow each
+    other without waiting, so the game runs as fast as it can be simulated;
+    the game only ever moves on by whole ticks, so it plays out the same
+    either way. Without paint, planets get no images, for games that no one
+    watches. The game ends when the host player disconnects, unless host is
+    None."""
+
+    def __init__(self, w, h, players, sendFn, recvFn, seed=None,
+                 fastForward=False, paint=True, host=0):
         self.w, self.h = w, h
         self.players = players
-        self.clock = pgtime.Clock()
+        self.host = host
+        self.fastForward = fastForward
+        self.clock = None if fastForward else pgtime.Clock()
         self.recvFn = recvFn
         self.sendFn = sendFn
-        self.mode = PreGame(w, h, self.players, self.sendFn, self.startGame)
+        self.mode = PreGame(w, h, self.players, self.sendFn, self.startGame,
+                            seed, paint)
         self.preGame = self.mode
         self.running = True
+        self.ticks = 0 # game ticks simulated
+        self.tickTime = 0 # seconds spent simulating them
 
     def run(self):
 
         while self.running:
 
-            self.inputHandler()
-
-            # step timer
-            self.timerFired()
+            self.step()
 
             # wait for clock
-            if self.mode:
+            if self.fastForward:
+                continue
+            elif self.mode:
                 self.clock.tick(self.mode.fps)
             else:
                 self.clock.tick(5)
 
+        self.close()
+        if self.fastForward:
+            print("Simulated %d ticks at %.1f ticks/s." %
+                  (self.ticks, self.ticksPerSecond()))
+
+    def close(self):
+        """Stops making the planet images that are still to come. The pool
+        they are made in is shared, so only this game's images are
+        cancelled."""
+        self.preGame.map.cancelImages()
+
+    def step(self):
+        self.inputHandler()
+
+        # step timer
+        self.timerFired()
+
+    def ticksPerSecond(self):
+        return self.ticks / self.tickTime if self.tickTime else 0.
+
     def startGame(self):
-        self.mode = Game(self.preGame, self.sendFn)
+        self.mode = Game(self.preGame, self.sendFn, self.host)
 
     # dispatchers
 
@@ -87,17 +137,27 @@ class GameServer():
             msg = self.recvFn()
 
     def timerFired(self):
+        # only the ticks of the game itself are counted
+        playing = isinstance(self.mode, Game)
+        start = time.perf_counter()
         if self.mode.timerFired():
             self.running = False
+        if playing:
+            self.tickTime += time.perf_counter() - start
+            self.ticks += 1
 
 class PreGame():
 
-    def __init__(self, w, h, players, sendFn, startFn):
+    def __init__(self, w, h, players, sendFn, startFn, seed=None,
+                 paint=True):
         self.fps = 5
         self.players = players
         self.sendFn = sendFn
         self.startFn = startFn
-        self.map = generateMap(w, h, players)
+        # replaying a seed loads the planet images from the texture cache
+        self.map = generateMap(w, h, players, seed=seed,
+                               progressive=PROGRESSIVE_MAPS, paint=paint)
+        self.seed = self.map.seed
         self.pNames = nameGen.generatePlanetNames(self.map)
         for p in range(self.players):
             self.sendFn(('tNo', p), p)
@@ -109,31 +169,42 @@ class PreGame():
             self.ready[pNo] = True
 
     def timerFired(self):
+        self.map.refinePackage(self.sendFn)
         if False not in self.ready:
             self.sendFn('ready')
             self.startFn()
 
 class Game():
 
-    def __init__(self, preGame, sendFn):
+    def __init__(self, preGame, sendFn, host=0):
         self.run = True
         self.fps = 24
         self.sendFn = sendFn
+        self.host = host # player whose leaving ends the game, or None
 
         # create teams
         self.teams = preGame.players
         self.teamsAlive = [t for t in range(self.teams)]
         self.teamsConnected = [t for t in range(self.teams)]
         self.gameOver = False
+        self.winner = None
 
         # make the map
         self.planetNames = preGame.pNames
         self.map = preGame.map
+        if max(self.map.w, self.map.h) >= stateSync.MAX_POS:
+            raise ValueError("ship positions on a %dx%d map do not fit in "
+                             "game data" % (self.map.w, self.map.h))
 
         # make ship containers
-        self.ships = sp.Group()
+        self.ships = ShipGroup()
         self.clusterNames = dict()
 
+        # the game data each team is sent is the changes since the last
+        # tick it acknowledged
+        self.tick = 0
+        self.broadcaster = stateSync.StateBroadcaster(self.teams)
+
         # set the starting bases
         for i, planet in enumerate(self.map.bases):
             planet.cap(i)
@@ -153,6 +224,8 @@ class Game():
                 clust = self.clusterNames[target]
                 destPlanet = self.planetNames[dest]
                 clust.changeDest(destPlanet)
+        elif msgType == 'ak':
+            self.broadcaster.ack(pNo, msgBody[0])
         elif msgType == 'ch':
             self.sendChat(pNo, msgBody[0])
         elif msgType == 'gg':
@@ -160,7 +233,7 @@ class Game():
             self.teamLose(pNo)
         elif msgType == 'dc':
             self.teamDC(pNo)
-            if pNo == 0: # host killed the connection!
+            if pNo == self.host: # host killed the connection!
                 self.gameOver = True
                 self.teamsConnected = []
         else: print(msg)
@@ -205,10 +278,16 @@ class Game():
             # now these teams have really lost
             self.teamLose(aliveCheck)
 
-        # send game data
-        for t in range(self.teams):
-            self.sendFn(('gd', self.gameClusterPackage(),
-                         self.map.gamePackage(t)), t)
+        self.map.refinePackage(self.sendFn)
+
+        # send game data: the clusters are the same for every team, the
+        # planets only show a team the units on its own
+        self.tick += 1
+        planets = [self.map.gamePackage(t) for t in range(self.teams)]
+        messages = self.broadcaster.package(self.tick, self.gameSnapshot(),
+                                            planets)
+        for t, msg in enumerate(messages):
+            self.sendFn(msg, t)
 
     def sendChat(self, pNo, msg):
         self.sendFn(('ch', pNo, msg))
@@ -229,31 +308,41 @@ class Game():
 
     def endGame(self):
         winTeam = self.teamsAlive.pop()
+        self.winner = winTeam
         self.sendFn(('gs', 'W'), winTeam)
         self.sendFn(('eg', winTeam))
         self.gameOver = True
 
     def teamDC(self, teamNo):
+        if teamNo not in self.teamsConnected: return
         self.sendChat(teamNo, 'Player disconnected.')
         if teamNo in self.teamsAlive:
             self.teamLose(teamNo)
-        if teamNo in self.teamsConnected:
-            self.teamsConnected.remove(teamNo)
-
-
-    def gameClusterPackage(self):
-        cList = dict()
-        for clName in self.clusterNames:
-            cList[clName] = self.clusterNames[clName].gamePackage()
-        return cList
+        self.teamsConnected.remove(teamNo)
+
+    def gameSnapshot(self):
+        """Returns the clusters as a stateSync.Snapshot."""
+        clusters = list(self.clusterNames.values())
+        ships = [ship for cluster in clusters for ship in cluster]
+        x = [ship.x for ship in ships]
+        y = [ship.y for ship in ships]
+        angle = [ship.angle for ship in ships]
+        return stateSync.Snapshot.quantise(
+            [c.name for c in clusters], [c.team for c in clusters],
+            [c.dest.pName for c in clusters], [len(c) for c in clusters],
+            x, y, angle)
 
 class Map(sp.Group):
 
-    def __init__(self, w, h, players):
+    def __init__(self, w, h, players, seed=None):
         super().__init__()
         self.w, self.h = w, h
         self.players = players
         self.bases = []
+        self.seed = rnd.getrandbits(32) if seed is None else seed
+        self.cache = None
+        self.pending = dict() # planet: (cache key, future of its image)
+        self.raster = None # made by planetRaster
 
     def addPlanet(self, location, r, img, units):
         newPlanet = Planet(self, location, r, img, units=units)
@@ -264,7 +353,27 @@ class Map(sp.Group):
     def preGamePackage(self, sendFn):
         sendFn(('dims', self.w, self.h, self.players, len(self)))
         for p in self:
-            sendFn(('p', p.loc, p.r, pgi.tostring(p.image, 'RGBA'), p.pName))
+            # unpainted maps send no images
+            img = None if p.image is None else pgi.tostring(p.image, 'RGBA')
+            sendFn(('p', p.loc, p.r, img, p.pName))
+
+    def refinePackage(self, sendFn):
+        """Sends the planet images that have been generated since the last
+        call, to replace their placeholders."""
+        for p, (key, future) in list(self.pending.items()):
+            if not future.done(): continue
+            del self.pending[p]
+            buf = future.result()
+            p.image = pgi.fromstring(buf, (p.r * 2 + 1, p.r * 2 + 1), 'RGBA')
+            self.cache.put(key, p.image)
+            sendFn(('pi', p.pName, buf))
+
+    def cancelImages(self):
+        """Cancels making the pending planet images that have not been
+        started, and forgets about all of them."""
+        for key, future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
 
     def gamePackage(self, t=-1):
         package = dict()
@@ -275,17 +384,61 @@ class Map(sp.Group):
                 package[p.pName] = p.team, None
         return package
 
+    def planetRaster(self):
+        """Makes the map's planet raster the first time it is asked for.
+        Each point of the raster holds the index of the first planet (in map
+        order) that a ship whose rect is centred there collides with, as
+        sp.collide_circle finds them, or -1. Ship rects have whole number
+        centres, so looking a ship up in the raster is exact."""
+        if self.raster is None:
+            self.planets = list(self)
+            reaches = [p.r + Ship.RADIUS for p in self.planets]
+            centres = [p.rect.center for p in self.planets]
+            self.rasterX = min(x - reach for (x, y), reach in
+                               zip(centres, reaches))
+            self.rasterY = min(y - reach for (x, y), reach in
+                               zip(centres, reaches))
+            w = max(x + reach for (x, y), reach in zip(centres, reaches))
+            h = max(y + reach for (x, y), reach in zip(centres, reaches))
+            self.raster = np.full((h - self.rasterY + 1, w - self.rasterX + 1),
+                                  -1, dtype=np.int16)
+            # earlier planets are drawn over later ones
+            for k in reversed(range(len(self.planets))):
+                (x, y), reach = centres[k], reaches[k]
+                x, y = x - self.rasterX, y - self.rasterY
+                d = np.arange(- reach, reach + 1)
+                square = self.raster[y - reach:y + reach + 1,
+                                     x - reach:x + reach + 1]
+                square[d[:, None] ** 2 + d[None, :] ** 2 <= reach ** 2] = k
+            self.rasterH, self.rasterW = self.raster.shape
+            self.rasterView = memoryview(self.raster)
+        return self.raster
+
+    def planetAt(self, x, y):
+        """Returns the planet a ship at (x, y) collides with, or None."""
+        if self.raster is None: self.planetRaster()
+        # where pg.Rect puts the centre of the ship's rect
+        col = int(x - Ship.RADIUS) + Ship.RADIUS - self.rasterX
+        row = int(y - Ship.RADIUS) + Ship.RADIUS - self.rasterY
+        if 0 <= row < self.rasterH and 0 <= col < self.rasterW:
+            # a memoryview gives plain ints, much faster than the array
+            k = self.rasterView[row, col]
+            if k >= 0: return self.planets[k]
+        return None
+
 class Planet(sp.Sprite):
 
     SPAWNTIME = 300
     SPAWNCAP = 50
 
-    def __init__(self, gameMap, location, r, img, units=0, pName=None):
+    def __init__(self, gameMap, location, r, img, units=0, pName=None,
+                 seed=None):
         super().__init__(gameMap)
         # init the planet
         self.map = gameMap
         self.x, self.y = location
         self.r = r
+        self.seed = seed
         self.spawnRate = r ** 2 // 100
         self.spawnTimer = 0
         self.capped = False
@@ -293,6 +446,7 @@ class Planet(sp.Sprite):
         self.team = None
         self.selected = False
         self.pName = pName
+        self.spawnRings = dict() # destination planet: SpawnRings
         # create the image
         self.image = img
 
@@ -343,43 +497,69 @@ class Planet(sp.Sprite):
     def containsPt(self, pt):
         return norm(self.loc, pt) < self.r
 
-    def sendShips(self, game, destPlanet):
+    def spawnRingsTo(self, destPlanet):
+        if destPlanet not in self.spawnRings:
+            self.spawnRings[destPlanet] = SpawnRings(self, destPlanet)
+        return self.spawnRings[destPlanet]
 
-        # finds available locations around a planet to spawn the
-        # ships in a circle around a planet
-        BUFFERSPACE = 1
+    def sendShips(self, game, destPlanet):
+        # spawns the ships at the first free points of the rings around
+        # the planet
         numShips = self.units // 2
 
         # create a new group of ships
         cluster = Cluster(destPlanet, self.team)
         game.clusterNames[cluster.name] = cluster
 
-        #initial values
-        startAngle = getAngle(*self.loc, *destPlanet.loc)
-        spawnDist = self.r + Ship.RADIUS + BUFFERSPACE
+        rings = self.spawnRingsTo(destPlanet)
         shipsMade = 0
+        ringNo = 0
         while shipsMade < numShips:
-            angleStep = math.asin((Ship.RADIUS + BUFFERSPACE) / (spawnDist))
-            currAngle = startAngle
-            while currAngle < pi * 2:
-                spawnPt = cartePlusPolar(*self.loc, spawnDist, currAngle)
-                tryShip = Ship(spawnPt, self, destPlanet)
-                collision = (sp.spritecollideany(tryShip, game.ships,
-                                                 Ship.collidedShip) or
-                             sp.spritecollideany(tryShip, game.map,
-                                                 Ship.collidedShip))
-                if collision:
-                    # failPoints.append(spawnPt)
-                    del tryShip # get rid of failed object
-                else:
-                    game.ships.add(tryShip)
-                    cluster.add(tryShip)
-                    shipsMade += 1
-                    self.units -= 1
-                    if shipsMade == numShips: break
-                currAngle += 2 * angleStep
-
-            spawnDist += 2 * Ship.RADIUS + BUFFERSPACE
+            pts, free = rings.ring(ringNo)
+            for spawnPt in itertools.compress(pts, free):
+                if game.ships.collidePt(*spawnPt): continue
+                newShip = Ship(spawnPt, self, destPlanet)
+                game.ships.add(newShip)
+                cluster.add(newShip)
+                shipsMade += 1
+                self.units -= 1
+                if shipsMade == numShips: break
+            ringNo += 1
+
+class SpawnRings():
+    """The points in rings around a planet where ships sent to one
+    destination are spawned, starting from the side facing it. A point is
+    free when it does not hit another planet, and ships are spawned at the
+    free points that no ship is too close to. Rings are made the first time
+    they are needed and kept, as they only depend on the map."""
+
+    BUFFERSPACE = 1
+
+    def __init__(self, planet, destPlanet):
+        self.planet = planet
+        self.startAngle = getAngle(*planet.loc, *destPlanet.loc)
+        self.rings = []
+        self.spawnDist = planet.r + Ship.RADIUS + SpawnRings.BUFFERSPACE
+
+    def ring(self, ringNo):
+        """Returns the points of a ring in the order they are tried and
+        which of them are free."""
+        while len(self.rings) <= ringNo:
+            self.rings.append(self.makeRing(self.spawnDist))
+            self.spawnDist += 2 * Ship.RADIUS + SpawnRings.BUFFERSPACE
+        return self.rings[ringNo]
+
+    def makeRing(self, spawnDist):
+        planet = self.planet
+        angleStep = math.asin((Ship.RADIUS + SpawnRings.BUFFERSPACE) /
+                              spawnDist)
+        pts = []
+        currAngle = self.startAngle
+        while currAngle < pi * 2:
+            pts.append(cartePlusPolar(*planet.loc, spawnDist, currAngle))
+            currAngle += 2 * angleStep
+        free = [planet.map.planetAt(*pt) in (None, planet) for pt in pts]
+        return pts, free
 
 class Cluster(sp.Group):
 
@@ -393,28 +573,41 @@ class Cluster(sp.Group):
         Cluster.INDEX += 1
 
     def move(self, ships, planets):
+        planetAt = planets.planetAt
 
         def moveUnit(unit, tryTurns):
+            # each try is only worked out here, and the ship is moved once
+            # one is free. Most ships move on their first try that misses
+            # the planets, so the ships it could hit are only gathered once
+            # that one is blocked
+            x, y, angle = unit.x, unit.y, unit.angle
+            destPlanet = unit.destPlanet
+            near = None
             for dist in range(Ship.VELOCITY, 0, -1):
                 for turn in tryTurns:
-                    unit.tryMove(dist, turn)
-                    collidePlanet = sp.spritecollideany(unit, planets,
-                                                        sp.collide_circle)
-                    if collidePlanet is unit.destPlanet:
-                        unit.destPlanet.arrival(self.team)
+                    tryX = x + dist * math.cos(angle + turn)
+                    tryY = y + dist * math.sin(angle + turn)
+                    collidePlanet = planetAt(tryX, tryY)
+                    if collidePlanet is destPlanet:
+                        destPlanet.arrival(self.team)
                         unit.kill()
                         return
+                    if collidePlanet is not None: continue
+                    if near is None:
+                        if ships.collidePt(tryX, tryY, unit) is None:
+                            unit.moveTo(tryX, tryY)
+                            ships.moved(unit)
+                            return
+                        near = ships.near(x, y, unit)
+                        continue
+                    for otherX, otherY in near:
+                        if ((otherX - tryX) ** 2 + (otherY - tryY) ** 2 <
+                            ShipGroup.REACH):
+                            break
                     else:
-                        pass
-                        # moveUnit(unit, filtertryTurns)
-                        # return
-                    if (len(sp.spritecollide(unit, ships, False,
-                                             Ship.collidedShip)) == 1 and
-                            not collidePlanet):
-                        unit.doMove()
+                        unit.moveTo(tryX, tryY)
+                        ships.moved(unit)
                         return
-                    else:
-                        unit.unTryMove()
 
         numTurns = int (Ship.MAXTURN // Ship.TURNANGLE)
         turnList = [i * Ship.TURNANGLE for i in range(- numTurns, numTurns + 1)]
@@ -423,8 +616,8 @@ class Cluster(sp.Group):
         for unit in self:
             # sorts the possible turns so that the ship tries to go forward
             # first
-            tryTurns = sorted(turnList, key=lambda x:
-                              abs(x + normalise(unit.offsetAngle)))
+            offset = normalise(unit.offsetAngle)
+            tryTurns = sorted(turnList, key=lambda x: abs(x + offset))
 
             moveUnit(unit, tryTurns)
 
@@ -433,12 +626,6 @@ class Cluster(sp.Group):
         for ship in self:
             ship.destPlanet = dest
 
-    def gamePackage(self):
-        ships = []
-        for ship in self:
-            ships.append((ship.loc, ship.angle))
-        return self.team, self.dest.pName, ships
-
     def checkArrival(self):
         for ship in self:
             if ship.arrive():
@@ -466,10 +653,6 @@ class Ship(sp.DirtySprite):
         self.h = self.w = Ship.RADIUS * 2
         self.angle = self.angleToDest
 
-        # for collision detection purposes
-        self.oldX, self.oldY = 0, 0
-        self.currTurn = 0
-
     @property
     def loc(self):
         return self.x, self.y
@@ -506,49 +689,190 @@ class Ship(sp.DirtySprite):
     def offsetAngle(self):
         return self.angle - self.angleToDest
 
-    # in the context of pathfinding, will need several parameters:
-    # a var tracking the current angle wrt to destination angle
-    # a var tracking destination angle
-    # vars for trying to move
-
-    def tryMove(self, dist, turn):
-        self.currTurn = turn
-        self.oldX, self.oldY = self.x, self.y
-        self.x, self.y = cartePlusPolar(self.x, self.y, dist,
-                                        self.angle + turn)
-
-    def unTryMove(self):
-        self.x, self.y = self.oldX, self.oldY
-
-    def doMove(self):
-        dist, angle = toPolar(self.x - self.oldX, self.y - self.oldY)
+    def moveTo(self, x, y):
+        dist, angle = toPolar(x - self.x, y - self.y)
+        self.x, self.y = x, y
         if dist != 0:
-            if abs(angle - self.angleToDest) < Ship.TURNANGLE:
+            angleToDest = self.angleToDest
+            if abs(angle - angleToDest) < Ship.TURNANGLE:
                 # this gets rid of some wobbling
-                angle = self.angleToDest
+                angle = angleToDest
             self.angle = angle
 
     def arrive(self):
         return self.destPlanet.containsPt(self.pts(1))
 
-def generateMap(w, h, players=2, planets=17, rMin=20, rMax=40):
-
-    MIN_PLANETS, MAX_PLANETS = 13, 25
-    planets = rnd.randint(MIN_PLANETS, MAX_PLANETS)
-    newMap = Map(w, h, players)
-    mapRect = pg.Rect(0, 0, w, h)
+class ShipGroup(sp.Group):
+    """Group of ships that also keeps them in a uniform grid, with cells as
+    wide as the collision distance, so that a collision query only looks at
+    the 3 x 3 cells around a point. Ships are put in the grid when they are
+    added and taken out when they are removed; call moved after a ship
+    moves."""
+
+    CELL = Ship.RADIUS * 2
+    REACH = (Ship.RADIUS * 2) ** 2 # squared distance ships collide within
+    NEAR = Ship.RADIUS * 2 + Ship.VELOCITY + 1
+
+    def __init__(self, *sprites):
+        self.cells = dict()
+        self.shipCells = dict()
+        super().__init__(*sprites)
+
+    @staticmethod
+    def cellOf(x, y):
+        return int(x // ShipGroup.CELL), int(y // ShipGroup.CELL)
+
+    def add_internal(self, sprite, *args):
+        super().add_internal(sprite, *args)
+        cell = ShipGroup.cellOf(sprite.x, sprite.y)
+        self.shipCells[sprite] = cell
+        self.cells.setdefault(cell, set()).add(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        cell = self.shipCells.pop(sprite)
+        self.cells[cell].discard(sprite)
+        if not self.cells[cell]: del self.cells[cell]
+
+    def moved(self, ship):
+        cell = ShipGroup.cellOf(ship.x, ship.y)
+        oldCell = self.shipCells[ship]
+        if cell == oldCell: return
+        self.cells[oldCell].discard(ship)
+        if not self.cells[oldCell]: del self.cells[oldCell]
+        self.shipCells[ship] = cell
+        self.cells.setdefault(cell, set()).add(ship)
+
+    def near(self, x, y, ship):
+        """Returns where the ships other than ship are that a ship moving
+        up to Ship.VELOCITY from (x, y) could collide with."""
+        reach = ShipGroup.NEAR
+        cells = self.cells
+        near = []
+        for cX in range(int((x - reach) // ShipGroup.CELL),
+                        int((x + reach) // ShipGroup.CELL) + 1):
+            for cY in range(int((y - reach) // ShipGroup.CELL),
+                            int((y + reach) // ShipGroup.CELL) + 1):
+                for other in cells.get((cX, cY), ()):
+                    if (other is not ship and (other.x - x) ** 2 +
+                        (other.y - y) ** 2 < reach ** 2):
+                        near.append((other.x, other.y))
+        return near
+
+    def collidePt(self, x, y, ship=None):
+        """Returns a ship other than ship that a ship at (x, y) would
+        collide with, or None."""
+        cX, cY = int(x // ShipGroup.CELL), int(y // ShipGroup.CELL)
+        get = self.cells.get
+        for cell in ((cX - 1, cY - 1), (cX - 1, cY), (cX - 1, cY + 1),
+                     (cX, cY - 1), (cX, cY), (cX, cY + 1),
+                     (cX + 1, cY - 1), (cX + 1, cY), (cX + 1, cY + 1)):
+            for other in get(cell, ()):
+                if (other is not ship and (other.x - x) ** 2 +
+                    (other.y - y) ** 2 < ShipGroup.REACH):
+                    return other
+        return None
+
+def generateMap(w, h, players=2, planets=17, rMin=20, rMax=40, seed=None,
+                cache=None, workers=MAP_WORKERS, pack=None, progressive=False,
+                paint=True):
+    """Generates a map. The same seed always gives the same map, and planet
+    images are loaded from the texture cache when they have been made
+    before. The planets are placed first, then the missing images are
+    generated, in worker processes if workers is not 0. With a texture pack
+    (texPack.getPack() by default), planets take their images from the pack
+    and only radii missing from it are generated. With progressive, missing
+    images start as placeholders and are generated in the background; the
+    map's refinePackage sends them when they are done. Without paint, the
+    planets are only placed and have no images, and pgen is not even
+    imported."""
+
+    newMap = Map(w, h, players, seed)
+    rng = rnd.Random(newMap.seed)
 
     # adding shine consistently to all the planets
     SHINE_R_MIN, SHINE_R_MAX = 0.1, 0.25
-    shineR = rnd.random() * (SHINE_R_MAX - SHINE_R_MIN) + SHINE_R_MIN
-    shineAngle = rnd.random() * 2 * pi
+    shineR = rng.random() * (SHINE_R_MAX - SHINE_R_MIN) + SHINE_R_MIN
+    shineAngle = rng.random() * 2 * pi
     shineX, shineY = toCarte(shineR, shineAngle)
 
-    def getImg(r):
-        img = pgen.genRandomPlanetImage(r)
-        pgen.shine(img, 0.5 + shineX, 0.5 + shineY)
-        pgen.fadeEdges(img, r, 0.8)
-        return img
+    placePlanets(newMap, rng, rMin, rMax)
+    if not paint: return newMap
+
+    # only painting needs pgen, which texPack imports too
+    import pgen
+    import texPack
+    if cache is None: cache = texCache.getCache()
+    if pack is None: pack = texPack.getPack()
+    # planets are seeded by the order they were added to the map
+    for i, p in enumerate(newMap):
+        p.seed = pgen.planetSeed(newMap.seed, i)
+    if pack is None:
+        paintPlanets(newMap, cache, shineX, shineY, workers,
+                     progressive=progressive)
+    else:
+        # the pack images all share one shine, which the rest have to match
+        for p in newMap:
+            picked = pack.pick(p.r, p.seed)
+            if picked is not None: p.image = picked[2]
+        paintPlanets(newMap, cache, pack.shineX, pack.shineY, workers,
+                     pack.fade, progressive)
+    return newMap
+
+def paintPlanets(gameMap, cache, shineX, shineY, workers=0, fade=0.8,
+                 progressive=False):
+    """Gives every planet on the map that does not have one its image. With
+    progressive, planets that are not cached get a placeholder, and their
+    images are left in gameMap.pending."""
+    import pgen
+    # read here so that the workers use the same mode as this process
+    style = 'recoloured' if pgen.RECOLOUR_LANDS else 'random'
+
+    toMake = dict()
+    for p in gameMap:
+        if p.image is not None: continue
+        key = (pgen.VERSION, p.seed, p.r, style, shineX, shineY, fade)
+        p.image = cache.get(key)
+        if p.image is None: toMake[p] = key
+    jobs = [(p.r, p.seed, shineX, shineY, fade, None, pgen.RECOLOUR_LANDS)
+            for p in toMake]
+
+    if progressive:
+        gameMap.cache = cache
+        pool = getPool(workers)
+        for (p, key), job in zip(toMake.items(), jobs):
+            p.image = pgen.genPlaceholderImage(*job[:5])
+            gameMap.pending[p] = key, pool.submit(pgen.genPlanetBuffer, job)
+        return
+
+    if workers != 0 and len(jobs) > 1:
+        # only raw pixels come back from the workers
+        buffers = getPool(workers).map(pgen.genPlanetBuffer, jobs)
+        images = [pgi.fromstring(buf, (p.r * 2 + 1, p.r * 2 + 1), 'RGBA')
+                  for p, buf in zip(toMake, buffers)]
+    else:
+        images = [pgen.genPlanetImage(*job) for job in jobs]
+
+    for (p, key), img in zip(toMake.items(), images):
+        p.image = img
+        cache.put(key, img)
+
+POOLS = dict()
+
+def getPool(workers=None):
+    """Returns a process pool with the given number of workers (None for one
+    per core, 0 for a single thread in this process). Pools are kept for the
+    next map."""
+    if workers not in POOLS:
+        if workers == 0: POOLS[workers] = futures.ThreadPoolExecutor(1)
+        else: POOLS[workers] = futures.ProcessPoolExecutor(workers)
+    return POOLS[workers]
+
+def placePlanets(newMap, rng, rMin, rMax):
+    w, h = newMap.w, newMap.h
+    MIN_PLANETS, MAX_PLANETS = 13, 25
+    planets = rng.randint(MIN_PLANETS, MAX_PLANETS)
+    mapRect = pg.Rect(0, 0, w, h)
 
     MAXTRIES = 5 # how many times to try in case of collisions
     MARG = 10 # margin around the planets where there should be no planets
@@ -564,28 +888,26 @@ def generateMap(w, h, players=2, planets=17, rMin=20, rMax=40):
     bsCY = BS_H // 2
     bsRMax = min(rMax, bsW, bsH)
     bsRMin = min(max(rMin, rMax - BS_PL_R_VAR), bsRMax)
-    bsR = rnd.randint(bsRMin, bsRMax)
-    bsDX = rnd.randint(- BS_W // 2 + bsR, BS_W // 2 - bsR)
-    bsDY = rnd.randint(- BS_H // 2 + bsR, BS_H // 2 - bsR)
+    bsR = rng.randint(bsRMin, bsRMax)
+    bsDX = rng.randint(- BS_W // 2 + bsR, BS_W // 2 - bsR)
+    bsDY = rng.randint(- BS_H // 2 + bsR, BS_H // 2 - bsR)
 
-    newMap.addPlanet((bsCX + bsDX, bsCY + bsDY), bsR, getImg(bsR),
-                     BS_ST_U)
-    newMap.addPlanet((bsCX + bsDX, h - bsCY - bsDY), bsR, getImg(bsR),
-                     BS_ST_U)
+    newMap.addPlanet((bsCX + bsDX, bsCY + bsDY), bsR, None, BS_ST_U)
+    newMap.addPlanet((bsCX + bsDX, h - bsCY - bsDY), bsR, None, BS_ST_U)
 
     # central planet if odd number of planets
     if planets % 2 == 1:
         planets -= 1
         # odd number of planets means have central planet
         for i in range(MAXTRIES):
-            mdX = rnd.randint(rMax, w - rMax)
+            mdX = rng.randint(rMax, w - rMax)
             mdY = h // 2
-            mdR = rnd.randint(rMin, rMax)
+            mdR = rng.randint(rMin, rMax)
             mdRect = RectSp(pg.Rect(mdX - mdR - MARG, mdY - mdR - MARG,
                                     (mdR + MARG) * 2, (mdR + MARG) * 2))
             if not sp.spritecollideany(mdRect, newMap):
-                newMap.addPlanet((mdX, mdY), mdR, getImg(mdR),
-                                 rnd.randint(MIN_ST_U, MAX_ST_U))
+                newMap.addPlanet((mdX, mdY), mdR, None,
+                                 rng.randint(MIN_ST_U, MAX_ST_U))
                 break
 
     # want to try to distribute planets around the map a bit
@@ -606,40 +928,40 @@ def generateMap(w, h, players=2, planets=17, rMin=20, rMax=40):
                 # no planets in this rect yet so make some
                 for i in range(MAXTRIES):
 
-                    r = rnd.randint(max(rMin, rMax - RIG_R_VAR), rMax)
-                    x = pgen.randNormalCutoff(col * rectW, (col + 1) * rectW,
-                                              DEV)
+                    r = rng.randint(max(rMin, rMax - RIG_R_VAR), rMax)
+                    x = randNormalCutoff(col * rectW, (col + 1) * rectW,
+                                         DEV, rng)
                     # the min is to make sure it's not too close to the
                     # center line to prevent collision across it
-                    y = pgen.randNormalCutoff(row * rectH,
-                    min((row + 1) * rectH, h // 2 - r - MARG // 2), DEV)
+                    y = randNormalCutoff(row * rectH,
+                    min((row + 1) * rectH, h // 2 - r - MARG // 2), DEV, rng)
                     pRect = RectSp(pg.Rect(x - r - MARG, y - r - MARG,
                                     (r + MARG) * 2, (r + MARG) * 2))
                     if (not sp.spritecollideany(pRect, newMap)
                         and mapRect.contains(pRect.rect)):
-                        stU = rnd.randint(MIN_ST_U, MAX_ST_U)
-                        newMap.addPlanet((x, y), r, getImg(r), stU)
-                        newMap.addPlanet((x, h - y), r, getImg(r), stU)
+                        stU = rng.randint(MIN_ST_U, MAX_ST_U)
+                        newMap.addPlanet((x, y), r, None, stU)
+                        newMap.addPlanet((x, h - y), r, None, stU)
                         planets -= 2
                         break
 
     # finally, make the rest of the planets
     for pl in range(planets // 2):
         for i in range(MAXTRIES):
-            r = rnd.randint(rMin, rMax)
-            x = rnd.randint(r, w - r)
-            y = rnd.randint(r, h // 2 - r - MARG)
+            r = rng.randint(rMin, rMax)
+            x = rng.randint(r, w - r)
+            y = rng.randint(r, h // 2 - r - MARG)
             pRect = RectSp(pg.Rect(x - r - MARG, y - r - MARG,
                             (r + MARG) * 2, (r + MARG) * 2))
             if (not sp.spritecollideany(pRect, newMap)
                 and mapRect.contains(pRect.rect)):
-                stU = rnd.randint(MIN_ST_U, MAX_ST_U)
-                newMap.addPlanet((x, y), r, getImg(r), stU)
-                newMap.addPlanet((x, h - y), r, getImg(r), stU)
+                stU = rng.randint(MIN_ST_U, MAX_ST_U)
+                newMap.addPlanet((x, y), r, None, stU)
+                newMap.addPlanet((x, h - y), r, None, stU)
                 break
     return newMap
 
-def start(w, h, sendFn, recvFn, p=2):
-    s = GameServer(w, h, p, sendFn, recvFn)
+def start(w, h, sendFn, recvFn, p=2, seed=None):
+    s = GameServer(w, h, p, sendFn, recvFn, seed)
     s.run()
     print("Game server shutting down!")
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""Plays games between AIs without a window, as fast as they can be
+simulated.
+
+    python headless.py --players 2 --matches 5 --seed 1
+
+The server runs in fast forward and the AIs are stepped along with it in
+the same thread, as often per game tick as they would be in real time, so
+a match plays out as it would on screen, only faster. Planet images are
+not made unless --paint is given. Set PYTHONHASHSEED as well as --seed to
+replay a match exactly, since planet names are picked from sets.
+"""
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import sys
+import time
+import random
+import argparse
+
+import ai
+import gameServerSide
+
+MAPW, MAPH = 768, 768 # as in gameClient
+MAX_TICKS = 24 * 60 * 10 # ten minutes of game time
+
+def runMatch(players, seed, maxTicks=MAX_TICKS, paint=False):
+    """Plays a match between AIs on the map of the given seed. Returns the
+    winning team (None if no team won within maxTicks), the game ticks
+    played, the ticks per second of the server alone and the seconds the
+    whole match took."""
+    start = time.perf_counter()
+    random.seed(seed)
+    bridge = ai.FakeServerBridge(players, player=False)
+    ais = [ai.AI(bridge.sendMsg, bridge.AIGetMsg) for p in range(players)]
+    server = gameServerSide.GameServer(MAPW, MAPH, players,
+                                       bridge.serverSendMsg,
+                                       bridge.serverGetMsg, seed,
+                                       fastForward=True, paint=paint)
+    aiSteps = 0
+    while server.running and server.ticks < maxTicks:
+        server.step()
+        # the AIs take fps steps for every second of game time
+        aiSteps += ais[0].fps / server.mode.fps
+        while aiSteps >= 1:
+            for a in ais: a.update()
+            aiSteps -= 1
+    server.close()
+    winner = getattr(server.mode, 'winner', None)
+    return (winner, server.ticks, server.ticksPerSecond(),
+            time.perf_counter() - start)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--players', type=int, default=2)
+    parser.add_argument('--matches', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the first match's map")
+    parser.add_argument('--max-ticks', type=int, default=MAX_TICKS)
+    parser.add_argument('--paint', action='store_true',
+                        help="make the planet images too")
+    args = parser.parse_args(argv)
+
+    print("%6s %7s %7s %10s %9s" % ("seed", "winner", "ticks", "ticks/s",
+                                     "seconds"))
+    for seed in range(args.seed, args.seed + args.matches):
+        winner, ticks, tickRate, seconds = runMatch(
+            args.players, seed, args.max_ticks, args.paint)
+        print("%6d %7s %7d %10.1f %9.2f" % (seed, winner, ticks, tickRate,
+                                            seconds))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
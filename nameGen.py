@@ -2,7 +2,8 @@ import os
 import random
 import re
 
-DIRECTORY = "nameDicts"
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "nameDicts")
 DEFAULTFILE = "default.txt"
 
 def generatePlanetNames(pMap, fileName=None):
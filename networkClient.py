@@ -7,6 +7,11 @@ PORT = 15112
 HEADERSIZE = 2 ** 8
 B_ORDER = 'big'
 
+def packMsg(msg):
+    """Returns the bytes sent for msg: a header holding the size of the
+    pickled msg, then the pickled msg."""
+    msgP = pickle.dumps(msg)
+    return len(msgP).to_bytes(HEADERSIZE, B_ORDER) + msgP
 
 # Some of this code is inspired by Rohan's optional socket lecture.
 # Nonetheless, I wrote every line myself and understand what is going on.
@@ -58,11 +63,8 @@ class ServerBridge():
         return self.connectThread.is_alive()
 
     def sendMsg(self, msg):
-        msgP = pickle.dumps(msg)
-        msgSizeB = len(msgP).to_bytes(HEADERSIZE, B_ORDER)
         try:
-            self.sck.send(msgSizeB)
-            self.sck.send(msgP)
+            self.sck.sendall(packMsg(msg))
         except OSError:
             print("Unable to connect to game server.")
 
@@ -116,14 +118,12 @@ def broadcastServer(clientDict, broadcastQueue):
     dc = []
     while broadcastActive:
         p, msg = broadcastQueue.get(True)
-        msgP = pickle.dumps(msg)
-        msgSizeB = len(msgP).to_bytes(HEADERSIZE, B_ORDER)
+        msgB = packMsg(msg)
         if p == -1:
             for i in clientDict:
                 address, incSocket = clientDict[i]
                 try:
-                    incSocket.send(msgSizeB)
-                    incSocket.send(msgP)
+                    incSocket.sendall(msgB)
                 except OSError: # socket closed
                     print(address, 'connection error')
                     dc.append(i)
@@ -142,8 +142,7 @@ def broadcastServer(clientDict, broadcastQueue):
         elif p in clientDict:
             address, incSocket = clientDict[p]
             try:
-                incSocket.send(msgSizeB)
-                incSocket.send(msgP)
+                incSocket.sendall(msgB)
             except OSError:
                 print(address, 'connection error')
                 clientDict.pop(p)
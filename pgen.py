@@ -1,32 +1,43 @@
-from random import *
+from random import Random
 import numpy as np
 import math
 import bisect
 import colorsys
+import functools
 import pygame as pg
 import pygame.gfxdraw as gfx
 import pygame.surfarray as sfa
 import pygame.transform as tf
 
-def callWithLargeStack(f,*args):
-    # this function take from course notes
-    import sys
-    import threading
-    threading.stack_size(2**27)  # 64MB stack
-    sys.setrecursionlimit(2**27) # will hit 64MB stack limit first
-    # need new thread to get the redefined stack size
-    def wrappedFn(resultWrapper): resultWrapper[0] = f(*args)
-    resultWrapper = [None]
-    thread = threading.Thread(target=wrappedFn, args=[resultWrapper])
-    thread.start()
-    thread.join()
-    return resultWrapper[0]
-
-def randNormalCutoff(a, b, dev=4):
+# bump whenever a change makes the generators give different images, so that
+# cached textures from older versions are not used
+VERSION = 3
+
+# make land planets by recolouring pooled land masks instead of growing new
+# lands for every planet
+RECOLOUR_LANDS = False
+
+# All the generators draw from an explicit random.Random passed as rng, so
+# that the same seed always gives the same image. Array work draws from a
+# NumPy RandomState seeded from that rng.
+
+def planetSeed(mapSeed, index):
+    """Derives the seed of the index-th planet of a map from the map seed."""
+    return Random('%d:%d' % (mapSeed, index)).getrandbits(32)
+
+def getRNG(rng=None):
+    return Random() if rng is None else rng
+
+def numpyRNG(rng):
+    """Returns a NumPy generator seeded from rng."""
+    return np.random.RandomState(rng.getrandbits(32))
+
+def randNormalCutoff(a, b, dev=4, rng=None):
+    rng = getRNG(rng)
     if a > b: a, b = b, a
-    delta = gauss(0, b - a / dev)
+    delta = rng.gauss(0, b - a / dev)
     if abs(delta) > (b - a) / 2:
-        return random() * (b - a) + a
+        return rng.random() * (b - a) + a
     return (a + b) / 2 + delta
 
 def normalise(tupList):
@@ -38,39 +49,61 @@ def normalise(tupList):
 def toCumulative(tup):
     return [sum(tup[:i+1]) for i in range(len(tup))]
 
-def weightedChoice(tupList):
+def weightedChoice(tupList, rng=None):
     """Returns a weighted choice from a list containing tuples of the form
     (name, weight)."""
     names, weights = zip(*tupList)
     weights = toCumulative(weights)
-    return names[bisect.bisect_left(weights, random())]
+    return names[bisect.bisect_left(weights, getRNG(rng).random())]
 
 def HtoR(h, s, l):
     SCALE = 255
     return tuple(map(lambda x: x * SCALE, colorsys.hls_to_rgb(h, l, s)))
 
-def genColor(hmin=0., hmax=1., smin=0., smax=1., lmin=0., lmax=1.):
+def genColor(hmin=0., hmax=1., smin=0., smax=1., lmin=0., lmax=1., rng=None):
     """Generate a random HSL color."""
+    rng = getRNG(rng)
     HSCALE = 1
     if hmin > hmax: hmin -= HSCALE
-    h = (random() * (hmax - hmin) + hmin) % HSCALE
-    s = random() * (smax - smin) + smin
-    l = random() * (lmax - lmin) + lmin
+    h = (rng.random() * (hmax - hmin) + hmin) % HSCALE
+    s = rng.random() * (smax - smin) + smin
+    l = rng.random() * (lmax - lmin) + lmin
     return h, s, l
 
-def genColorNormDist(hmin=0., hmax=1., smin=0., smax=1., lmin=0., lmax=1.):
+def genColorNormDist(hmin=0., hmax=1., smin=0., smax=1., lmin=0., lmax=1.,
+                     rng=None):
     """Generate a random HSL color with higher probability of being closer
     to center."""
+    rng = getRNG(rng)
     HSCALE = 1
     if hmin > hmax: hmin -= HSCALE
     params = (hmin, hmax), (smin, smax), (lmin, lmax)
-    return tuple(randNormalCutoff(mn, mx) for mn, mx in params)
-
-def gradientLine(l, col1, col2):
-    a = np.empty((1, 2, 3), dtype=int)
-    a[0][0] = HtoR(*col1)
-    a[0][1] = HtoR(*col2)
-    return tf.smoothscale(sfa.make_surface(a), (1, l))
+    return tuple(randNormalCutoff(mn, mx, rng=rng) for mn, mx in params)
+
+def gradientColumn(l, col1, col2):
+    """Returns an l x 3 array of RGB colours fading from col1 at the top to
+    col2 at the bottom, as if a two pixel line was smoothscaled to l."""
+    t = (np.arange(l) / l)[:, None]
+    rgb1, rgb2 = np.array(HtoR(*col1)), np.array(HtoR(*col2))
+    return rgb1 + (rgb2 - rgb1) * t
+
+def paintGradient(column, top, l, col1, col2):
+    """Paints an l row gradient into column starting at row top. Rows off
+    the column are skipped."""
+    lo, hi = max(top, 0), min(top + l, len(column))
+    if lo < hi:
+        column[lo:hi] = gradientColumn(l, col1, col2)[lo - top:hi - top]
+
+def fillCircleRows(sf, column, r):
+    """Writes the colours in column down every column of pixels in sf, cut
+    to a circle of radius r, in one pass over the packed pixels."""
+    rShift, gShift, bShift, aShift = sf.get_shifts()
+    rgb = np.rint(column).astype(np.uint32)
+    rows = ((rgb[:, 0] << rShift) | (rgb[:, 1] << gShift) |
+            (rgb[:, 2] << bShift))
+    a = sfa.pixels2d(sf)
+    np.bitwise_or(rows[None, :], circleMaskBits(r, aShift), out=a)
+    del a
 
 def whiteStar(r):
     a = np.full((3, 3, 3), 0, dtype=int)
@@ -80,22 +113,52 @@ def whiteStar(r):
     # a[2][2] = (255, 255, 255)
     return tf.smoothscale(sfa.make_surface(a), (r, r))
 
-def shineCircle(r):
+# The circle primitives below are drawn once per radius and kept as read-only
+# arrays. Each cache holds at most PRIMITIVES entries.
+PRIMITIVES = 64
+
+def readOnly(a):
+    a.flags.writeable = False
+    return a
+
+def surfaceFromArrays(rgb, alpha):
+    sf = pg.Surface(alpha.shape, flags=pg.SRCALPHA)
+    sfa.pixels3d(sf)[:] = rgb
+    sfa.pixels_alpha(sf)[:] = alpha
+    return sf
+
+@functools.lru_cache(PRIMITIVES)
+def shineCircleArrays(r):
+    """Returns the colour and alpha arrays of shineCircle(r)."""
     w = h = r * 2 + 1
     sf = pg.Surface((w, h), flags=pg.SRCALPHA)
     for i in range(r):
         alpha = (255 // r) * (i + 1)
         gfx.filled_circle(sf, r, r, r - i, (255, 255, 255, alpha))
-    return sf
+    return readOnly(sfa.array3d(sf)), readOnly(sfa.array_alpha(sf))
 
-def circleFadedEdges(r, startFade):
+def shineCircle(r):
+    return surfaceFromArrays(*shineCircleArrays(r))
+
+@functools.lru_cache(PRIMITIVES)
+def shineStamp(r):
+    """Returns a shared shineCircle(r), only to be blitted from."""
+    return shineCircle(r)
+
+@functools.lru_cache(PRIMITIVES)
+def circleFadedEdgesArrays(r, startFade):
+    """Returns the colour and alpha arrays of circleFadedEdges(r,
+    startFade)."""
     w = h = r * 2 + 1
     startR = int(startFade * r)
     sf = pg.Surface((w, h), flags=pg.SRCALPHA)
     for i in range(r - startR):
         alpha = (255 // (r - startR)) * (i + 1)
         gfx.filled_circle(sf, r, r, r - i, (255, 255, 255, alpha))
-    return sf
+    return readOnly(sfa.array3d(sf)), readOnly(sfa.array_alpha(sf))
+
+def circleFadedEdges(r, startFade):
+    return surfaceFromArrays(*circleFadedEdgesArrays(r, startFade))
 
 def fadingEllipse(rMaj, rMin, col=(0, 0, 1)):
     col = HtoR(*col)
@@ -113,21 +176,31 @@ def fadingEllipse(rMaj, rMin, col=(0, 0, 1)):
 def planetSolid(r, col1, col2):
     w = h = r * 2 + 1
     sf = pg.Surface((w, h), flags=pg.SRCALPHA)
-    tf.scale(gradientLine(h, col1, col2), (w, h), sf)
-    cutCircle(sf, r)
+    fillCircleRows(sf, gradientColumn(h, col1, col2), r)
     return sf
 
-def genPlanetSolid(r):
+def genPlanetSolid(r, rng=None):
+    return rotateCircle(*genPlanetSolidUnrotated(r, rng))
+
+def genPlanetSolidUnrotated(r, rng=None):
+    """Returns an unrotated solid planet and the angle to rotate it by."""
+    rng = getRNG(rng)
+    col, otherCol = genSolidColours(rng)
+    angle = rng.gauss(0, math.pi/6)
+    return planetSolid(r, col, otherCol), angle
+
+def genSolidColours(rng=None):
+    """Picks the two colours of a solid planet, in HSL."""
+    rng = getRNG(rng)
     schemeWeights = [('uranus', 1),
                      ('neptune', 0)]
     normalise(schemeWeights)
     bandColorRange1 = {'uranus': (0.08, 0.12, 0.2, 0.5, 0.4, 0.6),
                        'neptune': (0.6, 0.67, 0.9, 1, 0.45, 0.55)}
-    scheme = weightedChoice(schemeWeights)
-    col = genColor(smax=0.7, lmin=0.4, lmax=0.8)
-    otherCol = (coord + gauss(0, 0.08) for coord in col)
-    angle = gauss(0, math.pi/6)
-    return rotateCircle(planetSolid(r, col, otherCol), angle)
+    scheme = weightedChoice(schemeWeights, rng)
+    col = genColor(smax=0.7, lmin=0.4, lmax=0.8, rng=rng)
+    otherCol = tuple(coord + rng.gauss(0, 0.08) for coord in col)
+    return col, otherCol
 
 def planetBands(r, bands, smooth=True, sWidth=4):
     """Generates banded circle. bands is an iterable; each element should
@@ -148,7 +221,8 @@ def planetBands(r, bands, smooth=True, sWidth=4):
             startCols.append(colPair)
             endCols.append(colPair)
 
-    fill = pg.Surface((w, h), flags=pg.SRCALPHA)
+    # all the bands are painted into one column, then copied across
+    column = np.zeros((h, 3))
 
     en = 0
     for i in range(numBands):
@@ -156,20 +230,31 @@ def planetBands(r, bands, smooth=True, sWidth=4):
         en = int(ends[i] * h) - (sWidth if i < numBands - 1 else 0)
         bH = en - st # band height
         if bH < 0: continue
-        band = tf.scale(gradientLine(bH, startCols[i], endCols[i]), (w, bH))
-        fill.blit(band, (0, st))
+        paintGradient(column, st, bH, startCols[i], endCols[i])
 
     if smooth:
         for i in range(numBands - 1):
             bH = sWidth * 2 + 2
-            band = tf.scale(gradientLine(bH, endCols[i], startCols[i + 1]),
-                            (w, bH))
-            fill.blit(band, (0, int(ends[i] * h) - sWidth - 1))
+            paintGradient(column, int(ends[i] * h) - sWidth - 1, bH,
+                          endCols[i], startCols[i + 1])
 
-    cutCircle(fill, r)
+    fill = pg.Surface((w, h), flags=pg.SRCALPHA)
+    fillCircleRows(fill, column, r)
     return fill
 
-def genPlanetBands(r):
+def genPlanetBands(r, rng=None):
+    return rotateCircle(*genPlanetBandsUnrotated(r, rng))
+
+def genPlanetBandsUnrotated(r, rng=None):
+    """Returns an unrotated banded planet and the angle to rotate it by."""
+    rng = getRNG(rng)
+    bands = genBands(rng)
+    angle = rng.gauss(0, math.pi/15)
+    return planetBands(r, bands), angle
+
+def genBands(rng=None):
+    """Picks the bands of a banded planet, as planetBands takes them."""
+    rng = getRNG(rng)
     schemeWeights = [('jupiter', 7),
                      ('bluey', 5),
                      ('random', 1)]
@@ -177,77 +262,148 @@ def genPlanetBands(r):
     bandColorRange1 = {'jupiter': (0.08, 0.12, 0.2, 0.5, 0.4, 0.6),
                        'bluey': (0.45, 0.5, 0.85, 0.9, 0.3, 0.4),
                        'random': (0.0, 1.0, 0.2, 0.3, 0.4, 0.5)}
-    scheme = weightedChoice(schemeWeights)
-    numBands = randint(4, 8)
+    scheme = weightedChoice(schemeWeights, rng)
+    numBands = rng.randint(4, 8)
     bands = []
     for i in range(numBands - 1):
-        col = genColor(*bandColorRange1[scheme])
+        col = genColor(*bandColorRange1[scheme], rng=rng)
         # offset = gauss(0, 1 / (5 * numBands))
         # while abs(offset) > 1 / (2 * numBands): offset /= 1.1
         # width = (i + 1) * (1 / numBands) + offset
         endPc = (i + 1) * (1 / numBands)
         width = randNormalCutoff(endPc - 1 / (2 * numBands),
-                                 endPc + 1 / (2 * numBands))
+                                 endPc + 1 / (2 * numBands), rng=rng)
         bands.append((col, width))
-    bands.append((genColor(*bandColorRange1[scheme]), 1))
-    angle = gauss(0, math.pi/15)
-    return rotateCircle(planetBands(r, bands), angle)
+    bands.append((genColor(*bandColorRange1[scheme], rng=rng), 1))
+    return bands
+
+def labelComponents(n, us, vs):
+    """Labels the connected components of a graph with n nodes and edges
+    (us[i], vs[i]). Returns an array where each node holds the smallest node
+    number in its component."""
+    labels = np.arange(n)
+    while True:
+        lu, lv = labels[us], labels[vs]
+        differ = lu != lv
+        if not differ.any(): return labels
+        # hook the larger root onto the smaller one, then flatten the trees
+        np.minimum.at(labels, np.maximum(lu, lv)[differ],
+                      np.minimum(lu, lv)[differ])
+        while True:
+            jumped = labels[labels]
+            if (jumped == labels).all(): break
+            labels = jumped
+
+def growLands(landMask, lands, sizeProb, maxTries=10, rng=None):
+    """Grows up to lands continents over the pixels where landMask is
+    nonzero. Each neighbouring pair of pixels is joined with probability
+    sizeProb, and each land is the component containing a random seed. This
+    has the same distribution as growing the lands pixel by pixel. Returns
+    an array holding the land number of each pixel, or -1 for sea."""
+    rng = getRNG(rng)
+    npRNG = numpyRNG(rng)
+    mask = landMask != 0
+    w, h = mask.shape
+    idx = np.arange(w * h).reshape(w, h)
+    joinX = ((npRNG.random_sample((w - 1, h)) < sizeProb) &
+             mask[:-1] & mask[1:])
+    joinY = ((npRNG.random_sample((w, h - 1)) < sizeProb) &
+             mask[:, :-1] & mask[:, 1:])
+    us = np.concatenate((idx[:-1][joinX], idx[:, :-1][joinY]))
+    vs = np.concatenate((idx[1:][joinX], idx[:, 1:][joinY]))
+    labels = labelComponents(w * h, us, vs)
+
+    componentLand = np.full(w * h, -1)
+    land = 0
+    for i in range(lands):
+        for j in range(maxTries):
+            # find a land seed
+            x, y = rng.randint(0, w - 1), rng.randint(0, h - 1)
+            if mask[x, y] and componentLand[labels[idx[x, y]]] == -1: break
+        else: continue
+        componentLand[labels[idx[x, y]]] = land
+        land += 1
+    return componentLand[labels].reshape(w, h)
 
 def genLands(r, landCols, seaColRange, lands=10, sizeParam=1.,
-             colChangeRate=0.02):
+             colChangeRate=0.02, rng=None):
     """Generates a planet with seas and islands."""
-    DIRS = ((0, -1), (-1, 0), (0, 1), (1, 0))
-    MAXTRIES = 10 # number of times to try to find a land seed
-    PROBA, PROBB = 0.49, 1.1 # generation parameters
-
+    rng = getRNG(rng)
     if len(seaColRange) == 2: sf = planetSolid(r, *seaColRange)
     else: sf = planetSolid(r, seaColRange, seaColRange)
-    randAngle = random() * 2 * math.pi
+    randAngle = rng.random() * 2 * math.pi
     sf = rotateCircle(sf, randAngle)
-    sizeProb = (PROBA / sizeParam) * (1 - (1 / PROBB ** r))
-    landArray = circleMask(r).clip(0, 1)
+    classes = genLandClasses(r, len(landCols), lands, sizeParam,
+                             colChangeRate, rng)
+    landCols = np.array([HtoR(*col) for col in landCols])
+    isLand = classes > 0
     sfArray = sfa.pixels3d(sf)
-    d = r * 2
-
-    landCols = [HtoR(*col) for col in landCols]
-
-    def joinLands(y, x, landArray, sfArray, col):
-        if y < 0 or y > d or x < 0 or x > d or landArray[y][x] != 1: return
-        landArray[y][x] = 2
-        if random() < colChangeRate: sfArray[y][x] = choice(landCols)
-        else: sfArray[y][x] = col
-        for dy, dx in DIRS:
-            if random() < sizeProb: joinLands(y + dy, x + dx, landArray,
-                                              sfArray, col)
+    sfArray[isLand] = landCols[classes[isLand] - 1]
+    del sfArray
+    return sf
 
-    for i in range(lands):
-        for j in range(MAXTRIES):
-            # find a land seed
-            y, x = randint(0, d), randint(0, d)
-            if landArray[y][x] == 1: break
-        else: continue
-        # recursively generate land starting from the seed
-        callWithLargeStack(joinLands, x, y, landArray, sfArray,
-                           choice(landCols))
+def genLandClasses(r, numCols, lands=10, sizeParam=1., colChangeRate=0.02,
+                   rng=None):
+    """Grows the lands of a land planet of radius r. Returns an array with
+    0 for sea and k + 1 for land of colour k."""
+    rng = getRNG(rng)
+    MAXTRIES = 10 # number of times to try to find a land seed
+    PROBA, PROBB = 0.49, 1.1 # generation parameters
 
+    sizeProb = (PROBA / sizeParam) * (1 - (1 / PROBB ** r))
+    landArray = circleMask(r).clip(0, 1)
+    landNums = growLands(landArray, lands, sizeProb, MAXTRIES, rng)
+    isLand = landNums >= 0
+    landArray[isLand] = 2
+
+    # each land has its own colour, with some pixels changed at random
+    npRNG = numpyRNG(rng)
+    landColNums = npRNG.randint(numCols, size=lands)
+    classes = landColNums[landNums] + 1
+    change = npRNG.random_sample(landNums.shape) < colChangeRate
+    classes[change] = npRNG.randint(numCols,
+                                    size=np.count_nonzero(change)) + 1
+    classes[~isLand] = 0
 
     # get rid of 1x1 seas
-    h, w = landArray.shape
-    for y in range(h):
-        for x in range(w):
-            if (landArray[y][x] == 1 and
-                (x == 0 or landArray[y][x-1] == 2) and
-                (y == 0 or landArray[y-1][x] == 2) and
-                (x == w-1 or landArray[y][x+1] == 2) and
-                (y == h-1 or landArray[y+1][x] == 2)):
-                landArray[y][x] = 2
-                dy, dx = choice(DIRS)
-                if 0 < y < h-1 and 0 < x < w-1:
-                    sfArray[y][x] = sfArray[y + dy][x + dx]
+    fillSpecksArray(classes, landArray == 1, landArray == 2, rng)
+    return classes.astype(np.uint8)
+
+def fillSpecks(sf, holes, solid, rng=None):
+    """Morphological cleanup stage for generated planets. Every pixel in
+    holes whose four neighbours are all in solid (or off the edge) is filled
+    with the colour of a random neighbour. holes and solid are boolean
+    arrays the size of sf. Returns the mask of the filled pixels."""
+    sfArray = sfa.pixels3d(sf)
+    specks = fillSpecksArray(sfArray, holes, solid, rng)
     del sfArray
-    return sf
-
-def genPlanetLand(r, numLandCols=2):
+    return specks
+
+def fillSpecksArray(a, holes, solid, rng=None):
+    """fillSpecks for any array indexed [x, y], such as a class array."""
+    DX = np.array((0, -1, 0, 1))
+    DY = np.array((-1, 0, 1, 0))
+    solidPad = np.pad(solid, 1, mode='constant', constant_values=True)
+    specks = (holes & solidPad[:-2, 1:-1] & solidPad[2:, 1:-1] &
+              solidPad[1:-1, :-2] & solidPad[1:-1, 2:])
+    # pixels on the edge keep their own colour
+    xs, ys = np.nonzero(specks[1:-1, 1:-1])
+    xs += 1
+    ys += 1
+    dirs = numpyRNG(getRNG(rng)).randint(len(DX), size=len(xs))
+    a[xs, ys] = a[xs + DX[dirs], ys + DY[dirs]]
+    return specks
+
+def genPlanetLand(r, numLandCols=2, rng=None):
+    rng = getRNG(rng)
+    seaCol, landCols = genLandScheme(numLandCols, rng)
+    numLands = rng.randint(7, 10)
+    return genLands(r, landCols, seaCol, numLands, rng=rng)
+
+def genLandScheme(numLandCols=2, rng=None):
+    """Picks a land planet scheme. Returns the sea colour and numLandCols
+    land colours, in HSL."""
+    rng = getRNG(rng)
     schemeWeights = [('green', 5),
                     ('desert', 4),
                     ('mars', 2),
@@ -261,13 +417,79 @@ def genPlanetLand(r, numLandCols=2):
                          'desert': (0.1, 0.15, 0.5, 0.9, 0.5, 0.6),
                          'mars': (0.0, 0.4, 0.05, 0.1, 0.2, 0.3),
                          'badland': (0.0, 0.4, 0.05, 0.1, 0.05, 0.1)}
-    scheme = weightedChoice(schemeWeights)
-    seaCol = genColorNormDist(*seaColorRangeHSL[scheme])
+    scheme = weightedChoice(schemeWeights, rng)
+    seaCol = genColorNormDist(*seaColorRangeHSL[scheme], rng=rng)
     landCols = []
     for col in range(numLandCols):
-        landCols.append(genColorNormDist(*landColorRangeHSL[scheme]))
-    numLands = randint(7, 10)
-    return genLands(r, landCols, seaCol, numLands)
+        landCols.append(genColorNormDist(*landColorRangeHSL[scheme],
+                                         rng=rng))
+    return seaCol, landCols
+
+def genPlanetLandUnrotated(r, rng=None):
+    """Returns a land planet and the angle to rotate it by. Only the sea is
+    rotated, while it is generated, so the angle is None: the planet is not
+    to be rotated at all."""
+    return genPlanetLand(r, rng=rng), None
+
+# Recoloured land planets skip the growth: the lands come from a pool of
+# class arrays grown once per radius, and each planet only picks new colours
+# for the classes and a new rotation of one of the arrays.
+LAND_POOL = 8 # number of land class arrays kept per radius
+
+@functools.lru_cache(PRIMITIVES)
+def landClassPool(r, numLandCols=2):
+    """Returns LAND_POOL read-only land class arrays of radius r, each grown
+    from a fixed seed so that every process has the same pool."""
+    pool = []
+    for i in range(LAND_POOL):
+        rng = Random('land:%d:%d:%d' % (r, numLandCols, i))
+        pool.append(readOnly(genLandClasses(r, numLandCols,
+                                            rng.randint(7, 10), rng=rng)))
+    return tuple(pool)
+
+@functools.lru_cache(PRIMITIVES)
+def circleOffsets(r):
+    """Returns the x and y offsets of every pixel from the centre of a
+    circle of radius r, as read-only arrays indexed [x, y]."""
+    offsets = np.arange(-r, r + 1, dtype=float)
+    return (readOnly(np.repeat(offsets[:, None], r * 2 + 1, axis=1)),
+            readOnly(np.repeat(offsets[None, :], r * 2 + 1, axis=0)))
+
+def genPlanetLandRecoloured(r, numLandCols=2, rng=None):
+    """Makes a land planet by looking up new colours for a pooled land class
+    array, turned by a random angle and maybe mirrored."""
+    rng = getRNG(rng)
+    seaCol, landCols = genLandScheme(numLandCols, rng)
+    classes = landClassPool(r, numLandCols)[rng.randrange(LAND_POOL)]
+    angle = rng.random() * 2 * math.pi
+    mirror = rng.random() < 0.5
+
+    w = r * 2 + 1
+    sf = pg.Surface((w, w), flags=pg.SRCALPHA)
+    rShift, gShift, bShift, aShift = sf.get_shifts()
+    # the sea is rounded and the lands truncated, as genLands paints them
+    rgb = np.array([np.rint(HtoR(*seaCol))] +
+                   [HtoR(*col) for col in landCols]).astype(np.uint32)
+    palette = ((rgb[:, 0] << rShift) | (rgb[:, 1] << gShift) |
+               (rgb[:, 2] << bShift))
+
+    # nearest neighbour rotation: every pixel looks up where it came from
+    dx, dy = circleOffsets(r)
+    cos, sin = math.cos(angle), math.sin(angle)
+    xs = np.rint(cos * dx + sin * dy).astype(int) + r
+    ys = np.rint(cos * dy - sin * dx).astype(int) + r
+    np.clip(xs, 0, w - 1, out=xs)
+    np.clip(ys, 0, w - 1, out=ys)
+    if mirror: xs = w - 1 - xs
+    a = sfa.pixels2d(sf)
+    np.bitwise_or(palette[classes[xs, ys]], circleMaskBits(r, aShift), out=a)
+    del a
+    return sf
+
+def genPlanetLandRecolouredUnrotated(r, rng=None):
+    """Returns a recoloured land planet and the angle to rotate it by, which
+    is None since it is turned while it is made."""
+    return genPlanetLandRecoloured(r, rng=rng), None
 
 def rotateCircle(sf, angle):
     r = sf.get_width() // 2
@@ -277,18 +499,18 @@ def rotateCircle(sf, angle):
     newSf.blit(sf, (0, 0), area=pg.Rect(excess, excess, r * 2, r * 2))
     return newSf
 
-def generatePalette(numColors):
+def generatePalette(numColors, rng=None):
     # generate a starting color
-    seedColor = genColor(smin=0.5, smax=0.5, lmin=0.5, lmax=0.5)
+    seedColor = genColor(smin=0.5, smax=0.5, lmin=0.5, lmax=0.5, rng=rng)
 
 def shine(sf, xNorm, yNorm, rNorm=0.4):
     w, h = sf.get_width(), sf.get_height()
     r = int(rNorm * w)
-    sf.blit(shineCircle(r), (xNorm * w - r, yNorm * h - r))
+    sf.blit(shineStamp(r), (xNorm * w - r, yNorm * h - r))
     cropCircle(sf, min(w, h) // 2)
 
 def fadeEdges(sf, r, startFade=0.9):
-    alphas = sfa.array_alpha(circleFadedEdges(r, startFade))
+    rgb, alphas = circleFadedEdgesArrays(r, startFade)
     a = sfa.pixels_alpha(sf)
     a[:] = alphas
     del a
@@ -310,33 +532,200 @@ def cutCircle(fill, r):
     a[:] = cutout
     del a
 
+@functools.lru_cache(PRIMITIVES)
 def circleMask(r):
+    """Returns a read-only alpha array of a filled circle of radius r."""
     w = h = r * 2 + 1
     sf = pg.Surface((w, h), flags=pg.SRCALPHA)
     gfx.filled_circle(sf, r, r, r, (0, 0, 0, 255))
-    return sfa.array_alpha(sf)
+    return readOnly(sfa.array_alpha(sf))
 
-def genRandomPlanetImage(r):
+@functools.lru_cache(PRIMITIVES)
+def circleMaskBits(r, shift):
+    """Returns circleMask(r) as packed 32 bit pixels, shifted into the alpha
+    byte at shift."""
+    return readOnly(circleMask(r).astype(np.uint32) << shift)
+
+def genRandomPlanetImage(r, style=None, rng=None):
+    sf, angle = genRandomPlanetUnrotated(r, style, rng)
+    return sf if angle is None else rotateCircle(sf, angle)
+
+def pickStyle(rng=None):
+    """Picks a random planet style."""
     patterns = [('solid', 2),
                     ('bands', 1),
                     ('land', 1)]
     normalise(patterns)
-    funcList = {'solid': genPlanetSolid,
-                'bands': genPlanetBands,
-                'land' : genPlanetLand}
-    return funcList[weightedChoice(patterns)](r)
+    return weightedChoice(patterns, rng)
+
+def genRandomPlanetUnrotated(r, style=None, rng=None,
+                             recolourLands=None):
+    """Returns an unrotated planet of the given (or a random) style and the
+    angle to rotate it by, None for land planets. With recolourLands (RECOLOUR_LANDS by default),
+    land planets are recoloured from the pool instead of grown."""
+    funcList = {'solid': genPlanetSolidUnrotated,
+                'bands': genPlanetBandsUnrotated,
+                'land' : genPlanetLandUnrotated,
+                'landRecoloured': genPlanetLandRecolouredUnrotated}
+    rng = getRNG(rng)
+    if style is None: style = pickStyle(rng)
+    if recolourLands is None: recolourLands = RECOLOUR_LANDS
+    if style == 'land' and recolourLands: style = 'landRecoloured'
+    return funcList[style](r, rng=rng)
+
+def finishPlanet(sf, r, angle, shineXNorm, shineYNorm, fade, shineRNorm=0.4):
+    """Fused post-processing for a planet made by one of the Unrotated
+    generators. Does what rotateCircle (unless angle is None), shine and
+    fadeEdges do one after the other, but works in sf itself: the rotation is the only temporary
+    surface, the shine is a cached stamp, and the fade sets the alpha
+    directly, which also crops the planet."""
+    w = r * 2 + 1
+    # land planets are not rotated, and so not cropped by it either
+    if angle is not None:
+        rotated = tf.rotate(sf, math.degrees(angle))
+        excess = rotated.get_width() // 2 - r
+        sf.fill((0, 0, 0, 0))
+        sf.blit(rotated, (0, 0), area=pg.Rect(excess, excess, r * 2, r * 2))
+    shineR = int(shineRNorm * w)
+    sf.blit(shineStamp(shineR), (shineXNorm * w - shineR,
+                                 shineYNorm * w - shineR))
+    rgb, alphas = circleFadedEdgesArrays(r, fade)
+    a = sfa.pixels_alpha(sf)
+    a[:] = alphas
+    del a
+    return sf
 
-def genStarBG(w, h, stars=None, starRMin=3, starRMax=20, starRVar=0.5):
+def genPlanetImage(r, seed, shineX=0., shineY=0., fade=0.8, style=None,
+                   recolourLands=None):
+    """Generates a finished map planet from its seed, with shine and faded
+    edges."""
+    img, angle = genRandomPlanetUnrotated(r, style, Random(seed),
+                                          recolourLands)
+    return finishPlanet(img, r, angle, 0.5 + shineX, 0.5 + shineY, fade)
+
+def genPlaceholderImage(r, seed, shineX=0., shineY=0., fade=0.8,
+                        style=None):
+    """Makes a flat disc in the main colour of the planet that
+    genPlanetImage makes from the same seed, to show until that planet is
+    ready. Only the random draws up to the first colours are repeated."""
+    rng = Random(seed)
+    if style is None: style = pickStyle(rng)
+    if style == 'solid': col = genSolidColours(rng)[0]
+    elif style == 'bands': col = genBands(rng)[0][0]
+    else: col = genLandScheme(rng=rng)[0]
+    sf = planetSolid(r, col, col)
+    return finishPlanet(sf, r, None, 0.5 + shineX, 0.5 + shineY, fade)
+
+def genPlanetBuffer(args):
+    """Returns genPlanetImage(*args) as RGBA bytes, so that planets can be
+    generated in other processes."""
+    return pg.image.tostring(genPlanetImage(*args), 'RGBA')
+
+def packRects(sizes, maxW=None):
+    """Packs rectangles of the given (w, h) sizes into shelves, tallest
+    first. Returns the size of the packed area and a rect for each size, in
+    the order given."""
+    if not sizes: return (0, 0), []
+    if maxW is None:
+        area = sum(w * h for w, h in sizes)
+        maxW = max(max(w for w, h in sizes), int(math.sqrt(area) * 1.1))
+    rects = [None] * len(sizes)
+    x = y = shelfH = atlasW = 0
+    for i in sorted(range(len(sizes)), key=lambda i: sizes[i][1],
+                    reverse=True):
+        w, h = sizes[i]
+        if x + w > maxW and x > 0:
+            # start a new shelf
+            x, y, shelfH = 0, y + shelfH, 0
+        rects[i] = pg.Rect(x, y, w, h)
+        x += w
+        shelfH = max(shelfH, h)
+        atlasW = max(atlasW, x)
+    return (atlasW, y + shelfH), rects
+
+def packAtlas(images):
+    """Copies the images into one SRCALPHA atlas. Returns the atlas and the
+    rect of each image in it; atlas.subsurface(rect) gives the image back
+    without copying."""
+    size, rects = packRects([img.get_size() for img in images])
+    atlas = pg.Surface(size, flags=pg.SRCALPHA)
+    rgb, alpha = sfa.pixels3d(atlas), sfa.pixels_alpha(atlas)
+    for img, (x, y, w, h) in zip(images, rects):
+        # copied rather than blitted, so the alpha is kept exactly
+        rgb[x:x + w, y:y + h] = sfa.pixels3d(img)
+        alpha[x:x + w, y:y + h] = sfa.pixels_alpha(img)
+    del rgb, alpha
+    return atlas, rects
+
+def copyImage(dst, src):
+    """Copies the pixels of src into dst, which has the same size, keeping
+    the alpha exactly."""
+    rgb, alpha = sfa.pixels3d(dst), sfa.pixels_alpha(dst)
+    rgb[:] = sfa.pixels3d(src)
+    alpha[:] = sfa.pixels_alpha(src)
+    del rgb, alpha
+
+MIP_LEVELS = 3 # full, half and quarter size
+
+def genMipChain(sf, levels=MIP_LEVELS):
+    """Returns sf followed by smaller copies of it, each half the size of
+    the one before, so that it can be drawn small without scaling it
+    again."""
+    chain = [sf]
+    for level in range(levels - 1):
+        w, h = chain[-1].get_size()
+        chain.append(tf.smoothscale(chain[-1], (max(w // 2, 1),
+                                                max(h // 2, 1))))
+    return chain
+
+def nearestMip(chain, size):
+    """Returns the largest level of a mip chain that fits in a size x size
+    square, or the smallest level if none do."""
+    for level in chain:
+        if max(level.get_size()) <= size: return level
+    return chain[-1]
+
+@functools.lru_cache(PRIMITIVES)
+def starStamp(r):
+    """Returns the brightness of whiteStar(r) as a read-only r x r array."""
+    return readOnly(sfa.array3d(whiteStar(r))[:, :, 0].copy())
+
+def genStarBG(w, h, stars=None, starRMin=3, starRMax=20, starRVar=0.5,
+              rng=None):
+    """Generates a star field. Stars of each radius are stamped all at once
+    from a prerendered stamp, keeping the brightest value where stars
+    overlap."""
+    rng = getRNG(rng)
     if stars is None:
         stars = int(w * h / 10 ** 4)
     MARGIN = 5
-    bg = pg.Surface((w, h))
+    CHUNK = 2 ** 12 # stars stamped at once, to bound memory use
+    starsByR = dict()
     for s in range(stars):
-        x = randint(MARGIN, w - MARGIN)
-        y = randint(MARGIN, h - MARGIN)
-        r = int(starRMin + expovariate(starRVar))
+        x = rng.randint(MARGIN, w - MARGIN)
+        y = rng.randint(MARGIN, h - MARGIN)
+        r = int(starRMin + rng.expovariate(starRVar))
         if r > starRMax: r = starRMax
-        bg.blit(whiteStar(r), (x, y))
+        starsByR.setdefault(r, []).append((x, y))
+
+    bg = pg.Surface((w, h), depth=32)
+    # packed greys compare in the same order as their brightness
+    greys = np.array([bg.map_rgb((v, v, v)) for v in range(256)],
+                     dtype=np.uint32)
+    a = sfa.pixels2d(bg)
+    for r in sorted(starsByR):
+        stamp = starStamp(r)
+        dx, dy = np.nonzero(stamp)
+        values = greys[stamp[dx, dy]]
+        pts = starsByR[r]
+        for i in range(0, len(pts), CHUNK):
+            xs, ys = np.array(pts[i:i + CHUNK]).T
+            px = (xs[:, None] + dx).ravel()
+            py = (ys[:, None] + dy).ravel()
+            inside = (px < w) & (py < h)
+            np.maximum.at(a, (px[inside], py[inside]),
+                          np.tile(values, len(xs))[inside])
+    del a
     return bg
 
 ##### Tests
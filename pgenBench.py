@@ -0,0 +1,183 @@
+"""Headless benchmarks for pgen and map generation.
+
+Times each generator over a grid of radii and seeds and reports the mean and
+95th percentile time of each stage, with the peak memory allocated through
+Python (NumPy arrays included, SDL surfaces not). Results can be saved as a
+JSON baseline and later runs compared against it:
+
+    python pgenBench.py --save baseline.json
+    python pgenBench.py --compare baseline.json
+"""
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import sys
+import json
+import math
+import time
+import platform
+import argparse
+import tracemalloc
+from random import Random
+
+import numpy as np
+import pygame as pg
+
+import pgen
+import gameServerSide
+
+RADII = (20, 30, 40)
+SEEDS = 5
+MAPW, MAPH = 768, 768 # as in gameClient
+MAP_SEEDS = 3
+REPEATS = 3 # timed calls for each set of arguments
+THRESHOLD = 1.25 # slowdown against the baseline that counts as a regression
+
+class NullCache():
+    """Texture cache that never hits, so generateMap paints every planet."""
+
+    def get(self, key): return None
+
+    def put(self, key, sf): pass
+
+def timeStage(fn, argSets, prepare=None, repeats=REPEATS):
+    """Calls fn(*args) repeats times for each tuple in argSets and returns
+    its stats.
+    prepare(*args), if given, makes the arguments for each call outside of
+    the timing, for stages that change their input. Memory is traced in a
+    second pass, since tracing slows down the calls."""
+    times = []
+    for args in argSets * repeats:
+        if prepare is not None: args = prepare(*args)
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+
+    peak = 0
+    tracemalloc.start()
+    for args in argSets:
+        if prepare is not None: args = prepare(*args)
+        if hasattr(tracemalloc, 'reset_peak'): tracemalloc.reset_peak()
+        else:
+            # before Python 3.9, only starting again resets the peak
+            tracemalloc.stop()
+            tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        fn(*args)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return summarise(times, peak)
+
+def summarise(times, peak):
+    times = sorted(times)
+    p95 = times[min(len(times) - 1, math.ceil(len(times) * 0.95) - 1)]
+    return {'calls': len(times),
+            'meanMs': sum(times) / len(times) * 1000,
+            'p95Ms': p95 * 1000,
+            'peakKB': peak / 1024}
+
+# Arguments hold seeds rather than generators, so that every repeat of a
+# call makes the same image.
+
+def planetArgs(radii, seeds):
+    return [(r, seed) for r in radii for seed in range(seeds)]
+
+def genLands(r, seed):
+    landCols = [(0.3, 1, 0.5), (0.33, 0.9, 0.3), (0.15, 0.9, 0.6)]
+    seaCol = (0.6, 0.9, 0.5)
+    return pgen.genLands(r, landCols, seaCol, rng=Random(seed))
+
+def shineInput(r, seed):
+    # shine and fadeEdges change the planet, so each call gets a fresh one
+    return pgen.genPlanetSolid(r, Random(seed)), 0.4, 0.4
+
+def fadeInput(r, seed):
+    return pgen.genPlanetSolid(r, Random(seed)), r, 0.8
+
+def runBenchmarks(radii=RADII, seeds=SEEDS, mapSeeds=MAP_SEEDS):
+    planets = planetArgs(radii, seeds)
+    stages = [
+        ('genPlanetSolid',
+         lambda r, seed: pgen.genPlanetSolid(r, Random(seed)), planets, None),
+        ('genPlanetBands',
+         lambda r, seed: pgen.genPlanetBands(r, Random(seed)), planets, None),
+        ('genPlanetLand',
+         lambda r, seed: pgen.genPlanetLand(r, rng=Random(seed)), planets,
+         None),
+        ('genLands', genLands, planets, None),
+        ('genStarBG',
+         lambda seed: pgen.genStarBG(MAPW, MAPH, rng=Random(seed)),
+         [(seed,) for seed in range(seeds)], None),
+        ('shine', pgen.shine, planets, shineInput),
+        ('fadeEdges', pgen.fadeEdges, planets, fadeInput),
+        ('generateMap',
+         lambda seed: gameServerSide.generateMap(MAPW, MAPH, seed=seed,
+                                                 cache=NullCache(), workers=0),
+         [(seed,) for seed in range(mapSeeds)], None)]
+
+    results = dict()
+    for name, fn, argSets, prepare in stages:
+        # untimed calls so that the cached primitives are already made
+        for args in argSets:
+            fn(*(args if prepare is None else prepare(*args)))
+        results[name] = timeStage(fn, argSets, prepare)
+    return results
+
+def environment():
+    return {'python': platform.python_version(),
+            'pygame': pg.version.ver,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'pgenVersion': pgen.VERSION}
+
+def printResults(results, baseline=None):
+    print("%-16s %7s %10s %10s %10s" % ("stage", "calls", "mean ms",
+                                        "p95 ms", "peak KB"), end="")
+    print("   vs base" if baseline is not None else "")
+    regressions = []
+    for name, stats in results.items():
+        print("%-16s %7d %10.3f %10.3f %10.1f" % (name, stats['calls'],
+                stats['meanMs'], stats['p95Ms'], stats['peakKB']), end="")
+        if baseline is not None and name in baseline['results']:
+            ratio = stats['meanMs'] / baseline['results'][name]['meanMs']
+            print("   %6.2fx%s" % (ratio, " !" if ratio > THRESHOLD else ""))
+            if ratio > THRESHOLD: regressions.append(name)
+        else: print()
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--radii', type=int, nargs='+', default=RADII)
+    parser.add_argument('--seeds', type=int, default=SEEDS)
+    parser.add_argument('--map-seeds', type=int, default=MAP_SEEDS)
+    parser.add_argument('--save', metavar='FILE',
+                        help="save the results as a JSON baseline")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare the results with a JSON baseline")
+    args = parser.parse_args(argv)
+
+    pg.init()
+    results = runBenchmarks(args.radii, args.seeds, args.map_seeds)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        grid = (list(args.radii), args.seeds, args.map_seeds)
+        if grid != (baseline['radii'], baseline['seeds'],
+                    baseline['mapSeeds']):
+            print("The baseline was run on a different grid of radii and "
+                  "seeds.")
+    regressions = printResults(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(),
+                       'radii': list(args.radii), 'seeds': args.seeds,
+                       'mapSeeds': args.map_seeds, 'results': results},
+                      f, indent=2)
+    if regressions:
+        print("Slower than the baseline: " + ", ".join(regressions))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,393 @@
+"""Hosts many matches at once, in one process.
+
+    python roomServer.py --players 2
+
+Clients join it as they join a game started from the menu, at PORT. The
+lobby seats them in the order they connect, and a room's match starts as
+soon as all its seats are taken. Every socket is served by one event loop,
+which also steps each room's GameServer when its next tick is due, at the
+rate of the room's current mode. A room only takes time when it has a tick
+to simulate, and the server sleeps while none is due and nothing arrives.
+A new room's GameServer, which generates the map, is made in a builder
+thread, so that the rooms already playing keep their pace meanwhile.
+"""
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import sys
+import time
+import heapq
+import pickle
+import socket
+import argparse
+import selectors
+import traceback
+from collections import deque
+from concurrent import futures
+
+import networkClient as net
+import gameServerSide
+
+MAPW, MAPH = 768, 768 # as in gameClient
+LATE = 1 # seconds a room may fall behind before it skips the missed ticks
+LINGER = 5 # seconds a closing connection gets to take its last messages
+MAX_BACKLOG = 2 ** 23 # bytes waiting for a client before it is dropped
+
+class Connection():
+    """A client's socket, with the bytes read from it that do not make a
+    whole message yet and the bytes still to be written to it."""
+
+    def __init__(self, sck, address):
+        self.sck = sck
+        self.address = address
+        self.inBuf = bytearray()
+        self.outBuf = bytearray()
+        self.room = None
+        self.pNo = None
+        self.closed = False
+        self.closeBy = None # when a closing connection is given up on
+
+    @property
+    def left(self):
+        """Whether the client is gone or leaving."""
+        return self.closed or self.closeBy is not None
+
+    def messages(self):
+        """Returns the messages read in full so far."""
+        msgs = []
+        while len(self.inBuf) >= net.HEADERSIZE:
+            msgSize = int.from_bytes(self.inBuf[:net.HEADERSIZE], net.B_ORDER)
+            end = net.HEADERSIZE + msgSize
+            if len(self.inBuf) < end: break
+            msgs.append(pickle.loads(self.inBuf[net.HEADERSIZE:end]))
+            del self.inBuf[:end]
+        return msgs
+
+class Room():
+    """A match and the connections of its players. The room is the
+    GameServer's network: messages the players send wait in the inbox until
+    the match's next step. The server is made by makeServer, off the event
+    loop, and what it sends until the room starts waits in early."""
+
+    def __init__(self, network, number, connections):
+        self.network = network
+        self.number = number
+        self.connections = connections
+        self.inbox = deque()
+        self.early = []
+        self.server = None
+        self.started = False
+        self.closed = False
+        for pNo, conn in enumerate(connections):
+            conn.room, conn.pNo = self, pNo
+
+    def makeServer(self, seed=None):
+        # no player hosts a room, so its match goes on when any one leaves
+        return gameServerSide.GameServer(MAPW, MAPH, len(self.connections),
+                                         self.sendMsg, self.getMsg, seed,
+                                         host=None)
+
+    def start(self, server):
+        """Takes the server made by makeServer and sends what it sent so
+        far."""
+        self.server = server
+        self.started = True
+        for msg, p in self.early:
+            self.sendMsg(msg, p)
+        self.early = []
+
+    def sendMsg(self, msg, p=-1):
+        if msg is None: return
+        if not self.started:
+            # the network is only written to from the event loop
+            self.early.append((msg, p))
+            return
+        msgB = net.packMsg(msg)
+        if p == -1:
+            for conn in self.connections:
+                self.network.write(conn, msgB)
+        else: self.network.write(self.connections[p], msgB)
+
+    def getMsg(self):
+        return self.inbox.popleft() if self.inbox else None
+
+    def abandoned(self):
+        """A match that lost a player before it started can never start,
+        and one without players has no one to play for."""
+        if isinstance(self.server.mode, gameServerSide.PreGame):
+            return any(conn.left for conn in self.connections)
+        return all(conn.left for conn in self.connections)
+
+class RoomServer():
+
+    def __init__(self, IP, players, port=net.PORT):
+        if IP == "": IP = 'localhost'
+        self.players = players
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((IP, port))
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.lobby = [] # connections waiting for a room
+        self.rooms = dict() # number: room
+        self.roomCount = 0
+        self.schedule = [] # heap of (when the step is due, room number)
+        self.closing = set() # connections closed once their messages are sent
+        # rooms whose servers are being made, and the thread making them
+        self.opening = dict() # room: future of its server
+        self.builder = futures.ThreadPoolExecutor(1)
+        # the builder wakes the event loop up when a server is made
+        self.wakeUp, self.waker = socket.socketpair()
+        self.wakeUp.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeUp, selectors.EVENT_READ)
+
+    def serve(self):
+        print('Listening for players...')
+        while True:
+            self.poll(self.timeout())
+
+    def timeout(self):
+        """Returns how long the loop can wait for the network: until the
+        next step is due or a closing connection is given up on."""
+        due = [conn.closeBy for conn in self.closing]
+        if self.schedule: due.append(self.schedule[0][0])
+        if not due: return None
+        return max(0, min(due) - time.monotonic())
+
+    def poll(self, timeout=0):
+        """Handles what the network has for up to timeout seconds, then
+        steps the rooms that are due."""
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.listener:
+                self.accept()
+                continue
+            if key.fileobj is self.wakeUp:
+                try: self.wakeUp.recv(4096)
+                except BlockingIOError: pass
+                self.startRooms()
+                continue
+            conn = key.data
+            if events & selectors.EVENT_READ: self.read(conn)
+            if events & selectors.EVENT_WRITE: self.flush(conn)
+        self.stepRooms()
+        now = time.monotonic()
+        for conn in [conn for conn in self.closing if conn.closeBy <= now]:
+            print(conn.address, 'did not take its last messages')
+            self.drop(conn)
+
+    def shutdown(self):
+        self.selector.unregister(self.listener)
+        self.listener.close()
+        for room in list(self.rooms.values()):
+            self.closeRoom(room)
+        for conn in list(self.lobby):
+            self.drop(conn)
+        # the servers still being made are closed as soon as they are
+        self.builder.shutdown()
+        self.startRooms()
+        while self.closing:
+            self.poll(self.timeout())
+        self.selector.unregister(self.wakeUp)
+        self.wakeUp.close()
+        self.waker.close()
+        self.selector.close()
+
+    # lobby
+
+    def accept(self):
+        try: sck, address = self.listener.accept()
+        except BlockingIOError: return
+        print("Connected to", address)
+        sck.setblocking(False)
+        conn = Connection(sck, address)
+        self.selector.register(sck, selectors.EVENT_READ, conn)
+        self.lobby.append(conn)
+        if len(self.lobby) >= self.players:
+            players = self.lobby[:self.players]
+            del self.lobby[:self.players]
+            self.openRoom(players)
+
+    def openRoom(self, connections):
+        number = self.roomCount
+        self.roomCount += 1
+        room = Room(self, number, connections)
+        self.rooms[number] = room
+        future = self.builder.submit(room.makeServer)
+        self.opening[room] = future
+        future.add_done_callback(self.wake)
+
+    def wake(self, future):
+        try: self.waker.send(b'\0')
+        except OSError: pass # full of wake ups already, or shut down
+
+    def startRooms(self):
+        """Starts the rooms whose servers have been made."""
+        for room, future in list(self.opening.items()):
+            if not future.done(): continue
+            del self.opening[room]
+            if future.cancelled(): continue
+            try: server = future.result()
+            except Exception:
+                # a match that cannot start must not take the server down
+                traceback.print_exc()
+                if not room.closed:
+                    room.closed = True
+                    del self.rooms[room.number]
+                for conn in room.connections:
+                    self.drop(conn)
+                continue
+            if room.closed:
+                # closed while its server was being made
+                server.close()
+                continue
+            room.start(server)
+            heapq.heappush(self.schedule, (time.monotonic(), room.number))
+            print("Room %d started with %d players." %
+                  (room.number, len(room.connections)))
+
+    def closeRoom(self, room):
+        if room.closed: return
+        room.closed = True
+        del self.rooms[room.number]
+        if room in self.opening: self.opening[room].cancel()
+        if room.server is not None: room.server.close()
+        for conn in room.connections:
+            self.write(conn, net.packMsg('exit'))
+            self.finish(conn)
+        server = room.server
+        if server is None:
+            print("Room %d closed before it started." % room.number)
+            return
+        print("Room %d closed after %d ticks (%.1f ticks/s)." %
+              (room.number, server.ticks, server.ticksPerSecond()))
+
+    # scheduler
+
+    def stepRooms(self):
+        now = time.monotonic()
+        while self.schedule and self.schedule[0][0] <= now:
+            due, number = heapq.heappop(self.schedule)
+            room = self.rooms.get(number)
+            if room is None: continue
+            try:
+                room.server.step()
+            except Exception:
+                # a broken match must not take the other rooms down with it
+                traceback.print_exc()
+                room.server.running = False
+            if not room.server.running or room.abandoned():
+                self.closeRoom(room)
+                continue
+            due += 1 / room.server.mode.fps
+            if due < now - LATE: due = now
+            heapq.heappush(self.schedule, (due, number))
+
+    # network
+
+    def read(self, conn):
+        try: data = conn.sck.recv(65536)
+        except BlockingIOError: return
+        except OSError: data = b''
+        if conn.closeBy is not None:
+            # the client is only waiting for its last messages
+            if not data: self.drop(conn)
+            return
+        if not data:
+            print(conn.address, 'connection error')
+            self.lose(conn)
+            return
+        conn.inBuf += data
+        try: msgs = conn.messages()
+        except (pickle.UnpicklingError, EOFError):
+            print(conn.address, 'sent a broken message')
+            self.lose(conn)
+            return
+        for msg in msgs:
+            if msg == 'exit':
+                print(conn.address, "disconnected from server")
+                self.write(conn, net.packMsg('exit'))
+                self.leave(conn)
+                self.finish(conn)
+                return
+            if conn.room is not None:
+                conn.room.inbox.append((conn.pNo, msg))
+
+    def write(self, conn, msgB):
+        if conn.left: return
+        if not conn.outBuf:
+            try: sent = conn.sck.send(msgB)
+            except BlockingIOError: sent = 0
+            except OSError:
+                self.lose(conn)
+                return
+            if sent == len(msgB): return
+            msgB = memoryview(msgB)[sent:]
+            self.selector.modify(conn.sck,
+                                 selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                 conn)
+        conn.outBuf += msgB
+        if len(conn.outBuf) > MAX_BACKLOG:
+            print(conn.address, 'is not keeping up')
+            self.lose(conn)
+
+    def flush(self, conn):
+        if conn.closed: return
+        try: sent = conn.sck.send(conn.outBuf)
+        except BlockingIOError: return
+        except OSError:
+            self.lose(conn)
+            return
+        del conn.outBuf[:sent]
+        if conn.outBuf: return
+        if conn.closeBy is not None: self.drop(conn)
+        else: self.selector.modify(conn.sck, selectors.EVENT_READ, conn)
+
+    def finish(self, conn):
+        """Closes a connection once everything written to it is sent, or
+        after LINGER seconds."""
+        if conn.left: return
+        if not conn.outBuf:
+            self.drop(conn)
+            return
+        conn.closeBy = time.monotonic() + LINGER
+        self.closing.add(conn)
+
+    def drop(self, conn):
+        if conn.closed: return
+        conn.closed = True
+        self.selector.unregister(conn.sck)
+        conn.sck.close()
+        self.closing.discard(conn)
+        if conn in self.lobby: self.lobby.remove(conn)
+
+    def leave(self, conn):
+        """Tells the client's match that it disconnected."""
+        if conn.room is not None and not conn.room.closed:
+            conn.room.inbox.append((conn.pNo, ('dc', None)))
+
+    def lose(self, conn):
+        """Drops a client that went away without saying so."""
+        if conn.closed: return
+        self.drop(conn)
+        self.leave(conn)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--ip', default="",
+                        help="address to listen on (localhost by default)")
+    parser.add_argument('--players', type=int, default=2,
+                        help="players in each room")
+    parser.add_argument('--port', type=int, default=net.PORT)
+    args = parser.parse_args(argv)
+
+    server = RoomServer(args.ip, args.players, args.port)
+    try: server.serve()
+    except KeyboardInterrupt: pass
+    finally: server.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
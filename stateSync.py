@@ -0,0 +1,324 @@
+"""Game state packets that only carry what has changed.
+
+Every tick the server sends each team the clusters of ships and the teams
+and units of the planets. A StateSender sends a team the changes since the
+last state the team acknowledged ('gp', for patch), and the whole state
+('gk', for keyframe) every KEYFRAME ticks or when the team has not
+acknowledged any state the sender still has. A StateReceiver keeps the
+states that changes can be sent against, applies the changes and returns
+the state, which the receiver then acknowledges with ('ak', tick).
+
+All teams see the same clusters, while each only sees the units on its own
+planets. A StateBroadcaster keeps the senders of all the teams and makes
+the clusters part of a message once for each state it is sent against,
+already pickled, so that the teams acknowledging the same state are sent
+the very same bytes for it.
+
+Positions are sent in 1/POS_SCALE pixels as 16 bit integers and angles in
+1/ANGLE_STEPS of a turn as bytes, so that a ship's move since the last
+acknowledged state fits in three signed bytes. Clusters are kept as a
+Snapshot, which holds the ships in NumPy columns and is sent as the bytes
+of those columns, so that neither end handles the ships one by one.
+"""
+import math
+import pickle
+
+import numpy as np
+
+POS_SCALE = 8
+ANGLE_STEPS = 256
+KEYFRAME = 48 # ticks between keyframes
+HISTORY = 48 # ticks that states are kept for teams slow to acknowledge
+MAX_POS = 2 ** 15 // POS_SCALE # positions must be within this many pixels
+
+class Snapshot():
+    """The clusters of a game, quantised and in columns: the name, team,
+    destination and number of ships of each cluster, and the x, y and angle
+    of all the ships, cluster after cluster. Sent as the raw bytes of the
+    columns, little-endian."""
+
+    def __init__(self, names, teams, dests, counts, x, y, angle):
+        self.names = names # int32
+        self.teams = teams # uint8
+        self.dests = dests # tuple of planet names
+        self.counts = counts # uint16
+        self.x, self.y = x, y # int16, in 1/POS_SCALE pixels
+        self.angle = angle # uint8, in 1/ANGLE_STEPS turns
+        ends = np.cumsum(counts, dtype=np.int64)
+        self.starts = ends - counts
+        self.index = {name: i for i, name in enumerate(names.tolist())}
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def quantise(cls, names, teams, dests, counts, x, y, angle):
+        """Makes a snapshot from the clusters' columns and arrays of the
+        ships' x, y and angle. Positions beyond MAX_POS are clamped to it."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        angle = np.asarray(angle, dtype=float)
+        steps = np.rint(angle * ANGLE_STEPS / (2 * math.pi)).astype(np.int64)
+        return cls(np.array(names, dtype='<i4'), np.array(teams, dtype='u1'),
+                   tuple(dests), np.array(counts, dtype='<u2'),
+                   np.clip(np.rint(x * POS_SCALE), -2 ** 15,
+                           2 ** 15 - 1).astype('<i2'),
+                   np.clip(np.rint(y * POS_SCALE), -2 ** 15,
+                           2 ** 15 - 1).astype('<i2'),
+                   (steps % ANGLE_STEPS).astype('u1'))
+
+    def encode(self):
+        return (self.names.tobytes(), self.teams.tobytes(), self.dests,
+                self.counts.tobytes(), self.x.tobytes(), self.y.tobytes(),
+                self.angle.tobytes())
+
+    @classmethod
+    def decode(cls, data):
+        names, teams, dests, counts, x, y, angle = data
+        return cls(np.frombuffer(names, '<i4'), np.frombuffer(teams, 'u1'),
+                   dests, np.frombuffer(counts, '<u2'),
+                   np.frombuffer(x, '<i2'), np.frombuffer(y, '<i2'),
+                   np.frombuffer(angle, 'u1'))
+
+    def shipIndices(self, clusters):
+        """Returns the indices of the ships of the clusters with the given
+        indices, cluster after cluster."""
+        counts = self.counts[clusters].astype(np.int64)
+        ends = np.cumsum(counts)
+        return (np.arange(ends[-1] if len(ends) else 0) +
+                np.repeat(self.starts[clusters] - (ends - counts), counts))
+
+    def take(self, clusters):
+        """Returns a snapshot of the clusters with the given indices."""
+        clusters = np.asarray(clusters, dtype=np.int64)
+        ships = self.shipIndices(clusters)
+        return Snapshot(self.names[clusters], self.teams[clusters],
+                        tuple(self.dests[i] for i in clusters.tolist()),
+                        self.counts[clusters], self.x[ships], self.y[ships],
+                        self.angle[ships])
+
+    @staticmethod
+    def concatenate(snapshots):
+        return Snapshot(*[np.concatenate([getattr(s, column)
+                                          for s in snapshots])
+                          for column in ('names', 'teams')],
+                        sum((s.dests for s in snapshots), ()),
+                        *[np.concatenate([getattr(s, column)
+                                          for s in snapshots])
+                          for column in ('counts', 'x', 'y', 'angle')])
+
+    def clusters(self):
+        """Returns the clusters as {name: (team, dest, ships)}, where the
+        ships of a cluster are the rows x, y, angle of a float array."""
+        ships = np.column_stack((self.x / POS_SCALE, self.y / POS_SCALE,
+                                 self.angle * 2 * math.pi / ANGLE_STEPS))
+        shipsOf = [ships[start:start + count] for start, count in
+                   zip(self.starts.tolist(), self.counts.tolist())]
+        return dict(zip(self.names.tolist(),
+                        zip(self.teams.tolist(), self.dests, shipsOf)))
+
+def diffShips(old, new):
+    """Returns the indices of the ships of old that are gone and the moves
+    of the others to the ships of new, as a signed byte array of rows dx,
+    dy, dangle, or None if a move does not fit. old and new are lists of
+    (x, y, angle). Ships only ever leave a cluster, so new is old without
+    the ships that are gone, moved."""
+    gone = []
+    moves = []
+    i = 0
+    for x, y, a in new:
+        while True:
+            if i == len(old): return None
+            x0, y0, a0 = old[i]
+            dX, dY = x - x0, y - y0
+            if -128 <= dX < 128 and -128 <= dY < 128: break
+            gone.append(i)
+            i += 1
+        moves.append((dX, dY, (a - a0 + 128) % ANGLE_STEPS - 128))
+        i += 1
+    gone.extend(range(i, len(old)))
+    return tuple(gone), np.array(moves, dtype='i1').reshape(-1, 3)
+
+def shipRows(snapshot, cluster):
+    start = int(snapshot.starts[cluster])
+    end = start + int(snapshot.counts[cluster])
+    return list(zip(snapshot.x[start:end].tolist(),
+                    snapshot.y[start:end].tolist(),
+                    snapshot.angle[start:end].tolist()))
+
+def diffClusters(base, clusters):
+    """Returns the changes from the snapshot base to the snapshot clusters:
+    the names of the clusters that are gone, the encoded snapshot of the
+    clusters that are new (or whose ships could not be sent as moves), and
+    for the other clusters that changed their names, new destinations, gone
+    ships and the moves of all their ships one after the other."""
+    gone = tuple(name for name in base.index if name not in clusters.index)
+    names, dests = clusters.names.tolist(), clusters.dests
+    baseTeams, baseCounts = base.teams.tolist(), base.counts.tolist()
+    new, same, sameBase, fewer = [], [], [], []
+    for i, (name, team, count) in enumerate(zip(names,
+                                                clusters.teams.tolist(),
+                                                clusters.counts.tolist())):
+        b = base.index.get(name)
+        if b is None or baseTeams[b] != team or baseCounts[b] < count:
+            new.append(i)
+        elif baseCounts[b] == count:
+            same.append(i)
+            sameBase.append(b)
+        else: fewer.append((i, b))
+
+    # the clusters that kept all their ships are diffed all at once
+    ships = clusters.shipIndices(same)
+    baseShips = base.shipIndices(sameBase)
+    dX = clusters.x[ships].astype(np.int32) - base.x[baseShips]
+    dY = clusters.y[ships].astype(np.int32) - base.y[baseShips]
+    dA = ((clusters.angle[ships].astype(np.int32) - base.angle[baseShips] +
+           128) % ANGLE_STEPS - 128)
+    owner = np.repeat(np.arange(len(same)), clusters.counts[same])
+    far = (dX < -128) | (dX >= 128) | (dY < -128) | (dY >= 128)
+    farClusters = (np.bincount(owner, far, len(same)) > 0).tolist()
+    movedClusters = (np.bincount(owner, (dX != 0) | (dY != 0) | (dA != 0),
+                                 len(same)) > 0).tolist()
+
+    moved, newDests, goneShips = [], dict(), dict()
+    sent = np.zeros(len(same), dtype=bool)
+    for k, (i, b) in enumerate(zip(same, sameBase)):
+        if farClusters[k]: new.append(i)
+        elif movedClusters[k] or dests[i] != base.dests[b]:
+            sent[k] = True
+            moved.append(names[i])
+            if dests[i] != base.dests[b]: newDests[names[i]] = dests[i]
+    moves = [np.column_stack((dX, dY, dA))[sent[owner]].astype('i1')]
+
+    # the others lost ships, so which of their ships are gone is worked out
+    # ship by ship
+    for i, b in fewer:
+        shipChanges = diffShips(shipRows(base, b), shipRows(clusters, i))
+        if shipChanges is None:
+            new.append(i)
+            continue
+        moved.append(names[i])
+        if dests[i] != base.dests[b]: newDests[names[i]] = dests[i]
+        goneShips[names[i]] = shipChanges[0]
+        moves.append(shipChanges[1])
+    return (gone, clusters.take(sorted(new)).encode(),
+            (tuple(moved), newDests, goneShips,
+             np.concatenate(moves).tobytes()))
+
+def applyClusters(base, changes):
+    """Returns the snapshot that diffClusters(base, clusters) gave changes
+    for."""
+    goneClusters, new, (moved, dests, goneShips, moves) = changes
+    changed = set(goneClusters).union(moved)
+    kept = [i for i, name in enumerate(base.names.tolist())
+            if name not in changed]
+    movedIndex = [base.index[name] for name in moved]
+    ships = base.shipIndices(movedIndex)
+    counts = base.counts[movedIndex].astype(np.int64)
+    if goneShips:
+        dropped = []
+        for k, name in enumerate(moved):
+            if name in goneShips:
+                start = int(base.starts[movedIndex[k]])
+                dropped.extend(start + i for i in goneShips[name])
+                counts[k] -= len(goneShips[name])
+        ships = ships[~np.isin(ships, dropped)]
+    moves = np.frombuffer(moves, 'i1').reshape(-1, 3).astype(np.int32)
+    movedClusters = Snapshot(
+        np.array(moved, dtype='<i4'), base.teams[movedIndex],
+        tuple(dests.get(name, base.dests[i])
+              for name, i in zip(moved, movedIndex)),
+        counts.astype('<u2'), (base.x[ships] + moves[:, 0]).astype('<i2'),
+        (base.y[ships] + moves[:, 1]).astype('<i2'),
+        ((base.angle[ships] + moves[:, 2]) % ANGLE_STEPS).astype('u1'))
+    return Snapshot.concatenate([base.take(kept), movedClusters,
+                                 Snapshot.decode(new)])
+
+def diffPlanets(base, planets):
+    return {name: p for name, p in planets.items() if base.get(name) != p}
+
+def applyPlanets(base, changes):
+    planets = dict(base)
+    planets.update(changes)
+    return planets
+
+class StateSender():
+    """Sends one team the state of the game as changes to the last state it
+    acknowledged. States are pairs of clusters (a Snapshot) and planets (as
+    Map.gamePackage gives them for the team)."""
+
+    def __init__(self):
+        self.sent = dict() # tick: state, from the acknowledged state on
+        self.acked = None
+        self.keyframe = None # tick of the last keyframe
+
+    def package(self, tick, clusters, planets, encoded=None):
+        """Returns the message that brings the team to the state. encoded
+        holds the pickled clusters parts of messages made this tick, by the
+        tick they are sent against (None for keyframes), and gets the part
+        made here."""
+        if encoded is None: encoded = dict()
+        self.sent[tick] = clusters, planets
+        for t in [t for t in self.sent if t <= tick - HISTORY]:
+            del self.sent[t]
+        if (self.acked not in self.sent or
+            tick - self.keyframe >= KEYFRAME):
+            self.keyframe = tick
+            if None not in encoded:
+                encoded[None] = pickle.dumps(clusters.encode())
+            return 'gk', tick, encoded[None], planets
+        baseClusters, basePlanets = self.sent[self.acked]
+        if self.acked not in encoded:
+            encoded[self.acked] = pickle.dumps(diffClusters(baseClusters,
+                                                            clusters))
+        return ('gp', tick, self.acked, encoded[self.acked],
+                diffPlanets(basePlanets, planets))
+
+    def ack(self, tick):
+        if self.acked is not None and tick <= self.acked: return
+        self.acked = tick
+        for t in [t for t in self.sent if t < tick]:
+            del self.sent[t]
+
+class StateBroadcaster():
+    """Sends every team the state of the game, through a StateSender for
+    each."""
+
+    def __init__(self, teams):
+        self.senders = [StateSender() for t in range(teams)]
+
+    def package(self, tick, clusters, planets):
+        """Returns the message for each team, given the Snapshot of the
+        clusters and the planet package of each team."""
+        encoded = dict()
+        return [sender.package(tick, clusters, teamPlanets, encoded)
+                for sender, teamPlanets in zip(self.senders, planets)]
+
+    def ack(self, team, tick):
+        self.senders[team].ack(tick)
+
+class StateReceiver():
+    """Rebuilds the state of the game from a StateSender's messages."""
+
+    def __init__(self):
+        self.states = dict() # tick: state, that changes can be sent against
+
+    def receive(self, pkType, pk):
+        """Takes the body pk of a 'gk' or 'gp' message and returns the tick
+        of the state it brings the game to, with the clusters of that state
+        as Snapshot.clusters gives them and its planets as Map.gamePackage
+        gives them."""
+        if pkType == 'gk':
+            tick, clusters, planets = pk
+            clusters = Snapshot.decode(pickle.loads(clusters))
+            baseTick = tick - HISTORY + 1
+        else:
+            tick, baseTick, clusters, planets = pk
+            baseClusters, basePlanets = self.states[baseTick]
+            clusters = applyClusters(baseClusters, pickle.loads(clusters))
+            planets = applyPlanets(basePlanets, planets)
+        self.states[tick] = clusters, planets
+        # later changes are only sent against this base or newer states
+        for t in [t for t in self.states if t < baseTick]:
+            del self.states[t]
+        return tick, clusters.clusters(), planets
@@ -0,0 +1,135 @@
+import os
+import sys
+import random
+import threading
+import subprocess
+
+import pygame.sprite as sp
+
+import pgen
+import gameServerSide
+import texCache
+
+def makeGame(players, host=0, seed=5):
+    random.seed(seed)
+    sent = []
+    sendFn = lambda msg, p=-1: sent.append((msg, p))
+    preGame = gameServerSide.PreGame(768, 768, players, sendFn, lambda: None,
+                                     seed=seed, paint=False)
+    return gameServerSide.Game(preGame, sendFn, host), sent
+
+def test_hostLeavingEndsTheGame():
+    game, sent = makeGame(3)
+    game.inputHandler(0, ('dc', None))
+    assert game.gameOver
+
+def test_headlessMatchesDoNotNeedPgen():
+    # in a fresh interpreter, since other tests import pgen
+    code = ("import sys, headless; headless.runMatch(2, 1, maxTicks=50); "
+            "print('pgen' in sys.modules)")
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         cwd=os.path.dirname(os.path.dirname(
+                             os.path.abspath(__file__))),
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    assert out.stdout.split()[-1] == 'False'
+
+def test_withoutHostOnlyTheTeamLeaves():
+    game, sent = makeGame(3, host=None)
+    game.inputHandler(0, ('dc', None))
+    game.inputHandler(0, ('dc', None))
+    assert not game.gameOver
+    assert game.teamsConnected == [1, 2]
+    assert game.teamsAlive == [1, 2]
+    chats = [msg for msg, p in sent if msg[0] == 'ch']
+    assert len(chats) == 2 # disconnected, and lost
+
+def test_closingCancelsOnlyTheServersImages(monkeypatch, tmp_path):
+    monkeypatch.setattr(gameServerSide, 'PROGRESSIVE_MAPS', True)
+    monkeypatch.setattr(gameServerSide, 'MAP_WORKERS', 0)
+    monkeypatch.setattr(texCache, 'CACHE', texCache.TextureCache(tmp_path))
+    # no image is finished until the test is done with them
+    done = threading.Event()
+    monkeypatch.setattr(pgen, 'genPlanetBuffer', lambda job: done.wait())
+    try:
+        servers = [gameServerSide.GameServer(768, 768, 2, lambda *a: None,
+                                             lambda: None, seed, host=None)
+                   for seed in (1, 2)]
+        pending = [[future for key, future in
+                    server.preGame.map.pending.values()]
+                   for server in servers]
+        assert len(pending[0]) > 1 and len(pending[1]) > 1
+        servers[0].close()
+        # the first image is already being made and can only finish
+        assert not pending[0][0].cancelled()
+        assert all(future.cancelled() for future in pending[0][1:])
+        assert not any(future.cancelled() for future in pending[1])
+        assert not servers[0].preGame.map.pending
+        servers[1].close()
+    finally:
+        done.set()
+
+def baselineMove(cluster, ships, planets):
+    """Cluster.move as it was before the spatial hash and the planet raster,
+    trying each move on the ship and checking it against every sprite."""
+    Ship = gameServerSide.Ship
+
+    def moveUnit(unit, tryTurns):
+        for dist in range(Ship.VELOCITY, 0, -1):
+            for turn in tryTurns:
+                oldX, oldY = unit.x, unit.y
+                unit.x, unit.y = gameServerSide.cartePlusPolar(
+                    oldX, oldY, dist, unit.angle + turn)
+                collidePlanet = sp.spritecollideany(unit, planets,
+                                                    sp.collide_circle)
+                if collidePlanet is unit.destPlanet:
+                    unit.destPlanet.arrival(cluster.team)
+                    unit.kill()
+                    return
+                if (len(sp.spritecollide(unit, ships, False,
+                                         Ship.collidedShip)) == 1 and
+                        not collidePlanet):
+                    moved, angle = gameServerSide.toPolar(unit.x - oldX,
+                                                          unit.y - oldY)
+                    if moved != 0:
+                        if abs(angle - unit.angleToDest) < Ship.TURNANGLE:
+                            angle = unit.angleToDest
+                        unit.angle = angle
+                    ships.moved(unit)
+                    return
+                unit.x, unit.y = oldX, oldY
+
+    numTurns = int (Ship.MAXTURN // Ship.TURNANGLE)
+    turnList = [i * Ship.TURNANGLE for i in range(- numTurns, numTurns + 1)]
+    turnList += [Ship.MAXTURN, -Ship.MAXTURN]
+    for unit in cluster:
+        tryTurns = sorted(turnList, key=lambda x:
+                          abs(x + gameServerSide.normalise(unit.offsetAngle)))
+        moveUnit(unit, tryTurns)
+
+def playOut(monkeypatch, move=None, ticks=40):
+    """Plays a crowded game with random orders and returns what it sent."""
+    if move is not None:
+        monkeypatch.setattr(gameServerSide.Cluster, 'move', move)
+    monkeypatch.setattr(gameServerSide.Cluster, 'INDEX', 0)
+    game, sent = makeGame(2)
+    rng = random.Random(1)
+    names = sorted(game.planetNames)
+    for i, planet in enumerate(game.map):
+        planet.cap(i % 2)
+        planet.units = 20
+    for tick in range(ticks):
+        if tick % 15 == 0:
+            for team in range(2):
+                for name in names:
+                    if (game.planetNames[name].team == team and
+                        rng.random() < 0.6):
+                        game.inputHandler(team, ('op', name, rng.choice(names)))
+            if game.clusterNames:
+                cluster = rng.choice(sorted(game.clusterNames))
+                game.inputHandler(0, ('oc', cluster, rng.choice(names)))
+        game.timerFired()
+    return sent
+
+def test_shipsMoveAsTheyDidBefore(monkeypatch):
+    sent = playOut(monkeypatch)
+    assert playOut(monkeypatch, baselineMove) == sent
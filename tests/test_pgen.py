@@ -0,0 +1,29 @@
+from random import Random
+
+import pytest
+import pygame as pg
+
+import pgen
+
+def oldChain(r, seed, shineX, shineY, fade, style, recolourLands):
+    """Makes a map planet as the game did before finishPlanet: the finished
+    planet (rotated unless it is a land planet), then shine and fadeEdges."""
+    sf, angle = pgen.genRandomPlanetUnrotated(r, style, Random(seed),
+                                              recolourLands)
+    # lands were never rotated
+    if style != 'land': sf = pgen.rotateCircle(sf, angle)
+    pgen.shine(sf, 0.5 + shineX, 0.5 + shineY)
+    pgen.fadeEdges(sf, r, fade)
+    return sf
+
+@pytest.mark.parametrize('style, recolourLands', [('solid', False),
+                                                  ('bands', False),
+                                                  ('land', False),
+                                                  ('land', True)])
+@pytest.mark.parametrize('r', [5, 20, 40])
+def test_genPlanetImageMatchesTheOldChain(style, recolourLands, r):
+    for seed in range(3):
+        args = (r, seed, Random(seed).uniform(-0.25, 0.25), -0.1, 0.8, style,
+                recolourLands)
+        assert pg.image.tostring(pgen.genPlanetImage(*args), 'RGBA') == \
+            pg.image.tostring(oldChain(*args), 'RGBA')
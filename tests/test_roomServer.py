@@ -0,0 +1,114 @@
+import time
+import pickle
+import socket
+
+import pytest
+
+import networkClient as net
+import gameServerSide
+import roomServer
+
+class Client():
+    """A blocking test client that reads without waiting, so that the test
+    can run the server in between."""
+
+    def __init__(self, port):
+        self.sck = socket.create_connection(('localhost', port))
+        self.sck.setblocking(False)
+        self.inBuf = bytearray()
+        self.msgs = []
+
+    def send(self, msg):
+        self.sck.setblocking(True)
+        self.sck.sendall(net.packMsg(msg))
+        self.sck.setblocking(False)
+
+    def read(self):
+        while True:
+            try: data = self.sck.recv(1 << 16)
+            except BlockingIOError: break
+            if not data: break
+            self.inBuf += data
+        while len(self.inBuf) >= net.HEADERSIZE:
+            size = int.from_bytes(self.inBuf[:net.HEADERSIZE], net.B_ORDER)
+            end = net.HEADERSIZE + size
+            if len(self.inBuf) < end: break
+            self.msgs.append(pickle.loads(self.inBuf[net.HEADERSIZE:end]))
+            del self.inBuf[:end]
+
+def run(server, clients, until, seconds=10):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        server.poll(0.01)
+        for c in clients: c.read()
+        if until(): return
+    raise AssertionError("timed out")
+
+@pytest.fixture
+def server():
+    server = roomServer.RoomServer("", 3, port=0)
+    yield server
+    server.shutdown()
+
+def startMatch(server):
+    port = server.listener.getsockname()[1]
+    number = server.roomCount
+    clients = [Client(port) for i in range(3)]
+    run(server, clients, lambda: number in server.rooms)
+    room = server.rooms[number]
+    for c in clients: c.send('ready')
+    run(server, clients, lambda: room.server is not None and
+        isinstance(room.server.mode, gameServerSide.Game))
+    return room, clients
+
+def test_lostPlayerOnlyRemovesItsTeam(server):
+    room, clients = startMatch(server)
+    clients[0].sck.close()
+    game = room.server.mode
+    run(server, clients[1:], lambda: game.teamsConnected == [1, 2])
+    assert not game.gameOver
+    assert 0 not in game.teamsAlive
+
+def test_exitingPlayerLeavesTheMatch(server):
+    room, clients = startMatch(server)
+    clients[1].send('exit')
+    game = room.server.mode
+    run(server, clients, lambda: game.teamsConnected == [0, 2] and
+        'exit' in clients[1].msgs)
+    assert not game.gameOver
+
+def test_closingRoomSendsEverythingFirst(server):
+    room, clients = startMatch(server)
+    # small socket buffers, so that the message has to wait in outBuf
+    for conn in room.connections:
+        conn.sck.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    for c in clients:
+        c.sck.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    big = ('ch', 0, 'x' * (1 << 18))
+    room.sendMsg(big)
+    assert any(conn.outBuf for conn in room.connections)
+    server.closeRoom(room)
+    run(server, clients, lambda: all(c.msgs[-1:] == ['exit']
+                                     for c in clients))
+    for c in clients:
+        assert c.msgs[-2:] == [big, 'exit']
+    assert not server.closing
+
+def test_openingRoomDoesNotHoldUpOthers(server, monkeypatch):
+    room, clients = startMatch(server)
+    generateMap = gameServerSide.generateMap
+    ticked = []
+    def slowMap(*args, **kwargs):
+        # the map is only done once the other match has gone on for a while
+        end = time.monotonic() + 5
+        ticks = room.server.ticks
+        while room.server.ticks < ticks + 6 and time.monotonic() < end:
+            time.sleep(0.01)
+        ticked.append(room.server.ticks >= ticks + 6)
+        return generateMap(*args, **kwargs)
+    monkeypatch.setattr(gameServerSide, 'generateMap', slowMap)
+    port = server.listener.getsockname()[1]
+    others = [Client(port) for i in range(3)]
+    run(server, clients + others, lambda: all(
+        ('tNo', pNo) in c.msgs for pNo, c in enumerate(others)))
+    assert ticked == [True]
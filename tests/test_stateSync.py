@@ -0,0 +1,192 @@
+import math
+import random
+
+import numpy as np
+
+import stateSync
+from stateSync import Snapshot
+
+def canon(snapshot):
+    """The clusters of a snapshot as {name: (team, dest, [(x, y, angle)])}."""
+    clusters = dict()
+    for i, name in enumerate(snapshot.names.tolist()):
+        start = int(snapshot.starts[i])
+        end = start + int(snapshot.counts[i])
+        clusters[name] = (int(snapshot.teams[i]), snapshot.dests[i],
+                          list(zip(snapshot.x[start:end].tolist(),
+                                   snapshot.y[start:end].tolist(),
+                                   snapshot.angle[start:end].tolist())))
+    return clusters
+
+def quantise(clusters):
+    """Makes a snapshot from {name: (team, dest, [(x, y, angle)])}."""
+    names, teams, dests, counts, x, y, angle = [], [], [], [], [], [], []
+    for name, (team, dest, ships) in clusters.items():
+        names.append(name)
+        teams.append(team)
+        dests.append(dest)
+        counts.append(len(ships))
+        x.extend(s[0] for s in ships)
+        y.extend(s[1] for s in ships)
+        angle.extend(s[2] for s in ships)
+    return Snapshot.quantise(names, teams, dests, counts, x, y, angle)
+
+def test_quantiseRoundsLikePython():
+    rng = random.Random(1)
+    ships = [(rng.uniform(-5, 770), rng.uniform(-5, 770), rng.uniform(-7, 7))
+             for i in range(500)]
+    # exact halves of a step round to even
+    ships += [(k / 16, -k / 16, k * math.pi / 256) for k in range(-40, 40)]
+    snapshot = quantise({7: (2, 'a', ships)})
+    expected = [(round(x * stateSync.POS_SCALE), round(y * stateSync.POS_SCALE),
+                 round(a * stateSync.ANGLE_STEPS / (2 * math.pi)) %
+                 stateSync.ANGLE_STEPS) for x, y, a in ships]
+    assert canon(snapshot) == {7: (2, 'a', expected)}
+
+def test_positionsBeyondTheColumnsAreClamped():
+    far = stateSync.MAX_POS + 100
+    snapshot = quantise({0: (0, 'a', [(far, -far, 0.)])})
+    assert snapshot.x.tolist() == [2 ** 15 - 1]
+    assert snapshot.y.tolist() == [-2 ** 15]
+
+def test_encodeRoundTrip():
+    snapshot = quantise({3: (1, 'a', [(1., 2., 3.), (4., 5., 6.)]),
+                         9: (0, 'b', []),
+                         4: (5, 'c', [(700., 10., -1.)])})
+    decoded = Snapshot.decode(snapshot.encode())
+    assert canon(decoded) == canon(snapshot)
+    assert list(decoded.names) == [3, 9, 4]
+
+def test_clustersGivesFloatArrays():
+    snapshot = quantise({3: (1, 'a', [(1.5, 2.25, math.pi / 2)]),
+                         4: (0, 'b', [])})
+    clusters = snapshot.clusters()
+    team, dest, ships = clusters[3]
+    assert (team, dest) == (1, 'a')
+    assert ships.tolist() == [[1.5, 2.25, math.pi / 2]]
+    assert clusters[4][2].shape == (0, 3)
+
+def randomStep(clusters, rng, nextName):
+    """Moves the clusters on one tick: ships fly (now and then too far to be
+    sent as a move), leave clusters and turn, and clusters come, go and
+    change destination."""
+    stepped = dict()
+    for name, (team, dest, ships) in clusters.items():
+        if rng.random() < 0.05: continue
+        if rng.random() < 0.1: dest = rng.choice('abc')
+        if rng.random() < 0.03: team = (team + 1) % 6
+        moved = []
+        for x, y, a in ships:
+            if rng.random() < 0.1: continue
+            step = 40 if rng.random() < 0.02 else 3
+            moved.append((x + rng.uniform(-step, step),
+                          y + rng.uniform(-step, step),
+                          a + rng.uniform(-1, 1)))
+        stepped[name] = team, dest, moved
+    for i in range(rng.randrange(3)):
+        stepped[nextName + i] = (rng.randrange(6), rng.choice('abc'),
+                                 [(rng.uniform(0, 768), rng.uniform(0, 768),
+                                   rng.uniform(-4, 4))
+                                  for k in range(rng.randrange(30))])
+    return stepped
+
+def test_applyingTheDiffGivesTheClusters():
+    rng = random.Random(2)
+    clusters = randomStep(dict(), rng, 0)
+    history = [quantise(clusters)]
+    for tick in range(1, 150):
+        clusters = randomStep(clusters, rng, tick * 10)
+        snapshot = quantise(clusters)
+        # against the last state and against one a few ticks back
+        for base in (history[-1], history[max(0, len(history) - 5)]):
+            changes = stateSync.diffClusters(base, snapshot)
+            assert canon(stateSync.applyClusters(base, changes)) == \
+                canon(snapshot)
+        history.append(snapshot)
+
+def states(ticks, seed=3):
+    """Yields (tick, clusters, planets) for a random game."""
+    rng = random.Random(seed)
+    clusters = dict()
+    planets = {name: (0, 10) for name in range(6)}
+    for tick in range(ticks):
+        clusters = randomStep(clusters, rng, tick * 10)
+        planets = dict(planets)
+        name = rng.randrange(6)
+        planets[name] = (rng.randrange(3), rng.randrange(100))
+        yield tick, quantise(clusters), planets
+
+def sameClusters(received, sent):
+    assert received.keys() == sent.keys()
+    for name, (team, dest, ships) in sent.items():
+        assert received[name][:2] == (team, dest)
+        assert received[name][2].tolist() == ships.tolist()
+
+def test_receiverFollowsTheSender():
+    """Messages arrive two ticks late, their acks three ticks after that,
+    and one ack in four is lost."""
+    rng = random.Random(4)
+    sender = stateSync.StateSender()
+    receiver = stateSync.StateReceiver()
+    inFlight, acks, kinds = [], [], []
+    for tick, clusters, planets in states(200):
+        msg = sender.package(tick, clusters, planets)
+        kinds.append(msg[0])
+        inFlight.append((tick + 2, msg, clusters, planets))
+        while inFlight and inFlight[0][0] <= tick:
+            due, msg, sentClusters, sentPlanets = inFlight.pop(0)
+            got, gotClusters, gotPlanets = receiver.receive(msg[0], msg[1:])
+            assert got == msg[1]
+            sameClusters(gotClusters, sentClusters.clusters())
+            assert gotPlanets == sentPlanets
+            if rng.random() < 0.75: acks.append((tick + 3, got))
+        while acks and acks[0][0] <= tick:
+            sender.ack(acks.pop(0)[1])
+    assert kinds[0] == 'gk' and 'gp' in kinds
+    # a keyframe at least every KEYFRAME ticks even when acks come
+    keyframes = [tick for tick, kind in enumerate(kinds) if kind == 'gk']
+    assert all(b - a <= stateSync.KEYFRAME
+               for a, b in zip(keyframes, keyframes[1:]))
+
+def test_changesAreSentAgainstTheLastAck():
+    sender = stateSync.StateSender()
+    game = states(10)
+    assert sender.package(*next(game))[0] == 'gk'
+    sender.ack(0)
+    msg = sender.package(*next(game))
+    assert msg[:3] == ('gp', 1, 0)
+    sender.ack(1)
+    sender.ack(0) # arrives late and is ignored
+    assert sender.package(*next(game))[:3] == ('gp', 2, 1)
+    assert sender.acked == 1 and 0 not in sender.sent
+
+def test_withoutAcksOnlyKeyframesAreSent():
+    sender = stateSync.StateSender()
+    assert all(sender.package(*state)[0] == 'gk' for state in states(60))
+
+def test_anAckTooOldForTheHistoryGetsAKeyframe(monkeypatch):
+    # only the history can make this keyframe
+    monkeypatch.setattr(stateSync, 'KEYFRAME', 10 * stateSync.HISTORY)
+    sender = stateSync.StateSender()
+    game = states(stateSync.HISTORY + 5)
+    sender.package(*next(game))
+    sender.ack(0)
+    for tick, clusters, planets in game:
+        msg = sender.package(tick, clusters, planets)
+        if tick < stateSync.HISTORY: assert msg[0] == 'gp'
+        else: break
+    # the team's state fell out of the history
+    assert msg[0] == 'gk'
+
+def test_broadcasterSharesThePayload():
+    broadcaster = stateSync.StateBroadcaster(3)
+    game = states(10)
+    tick, clusters, planets = next(game)
+    msgs = broadcaster.package(tick, clusters, [planets] * 3)
+    assert msgs[0][2] is msgs[1][2] is msgs[2][2]
+    broadcaster.ack(0, 0)
+    broadcaster.ack(1, 0)
+    tick, clusters, planets = next(game)
+    msgs = broadcaster.package(tick, clusters, [planets] * 3)
+    assert [msg[0] for msg in msgs] == ['gp', 'gp', 'gk']
+    assert msgs[0][3] is msgs[1][3]
@@ -0,0 +1,32 @@
+import pygame as pg
+
+import texCache
+
+def makeSurface():
+    sf = pg.Surface((4, 3), pg.SRCALPHA)
+    sf.fill((10, 20, 30, 255))
+    return sf
+
+def pixels(sf):
+    return pg.image.tostring(sf, 'RGBA')
+
+def test_texturesCanBeDrawnOn(tmp_path):
+    cache = texCache.TextureCache(str(tmp_path))
+    sf = makeSurface()
+    expected = pixels(sf)
+    cache.put('key', sf)
+    sf.fill((255, 0, 0, 255))
+    got = cache.get('key')
+    assert pixels(got) == expected
+    got.fill((0, 255, 0, 255))
+    assert pixels(cache.get('key')) == expected
+
+def test_texturesLoadedFromDiskCanBeDrawnOn(tmp_path):
+    texCache.TextureCache(str(tmp_path)).put('key', makeSurface())
+    expected = pixels(makeSurface())
+    cache = texCache.TextureCache(str(tmp_path))
+    got = cache.get('key')
+    assert pixels(got) == expected
+    got.fill((0, 255, 0, 255))
+    assert pixels(cache.get('key')) == expected
+    assert cache.get('other') is None
@@ -0,0 +1,77 @@
+import struct
+
+import pytest
+import pygame as pg
+
+import pgen
+import texPack
+
+@pytest.fixture
+def pack(tmp_path):
+    fileName = str(tmp_path / 'planets.pack')
+    texPack.buildPack(fileName, range(5, 7), 2, seed=3, workers=1)
+    return texPack.TexturePack(fileName)
+
+def test_roundTrip(pack):
+    assert len(pack) == 4
+    assert pack.radii() == [5, 6]
+    for i, r in enumerate((5, 5, 6, 6)):
+        seed, style, image = pack.pick(r, i)
+        assert style == 'random'
+        expected = pgen.genPlanetBuffer((r, seed, pack.shineX, pack.shineY,
+                                         pack.fade, None))
+        assert pg.image.tostring(image, 'RGBA') == expected
+    assert pack.pick(7, 0) is None
+
+def test_picksCanBeDrawnOn(pack):
+    image = pack.pick(5, 0)[2]
+    before = pg.image.tostring(pack.pick(5, 0)[2], 'RGBA')
+    image.fill((255, 0, 0, 255))
+    assert pg.image.tostring(pack.pick(5, 0)[2], 'RGBA') == before
+
+def test_stalePackIsRejected(pack, tmp_path):
+    with open(pack.fileName, 'rb') as f:
+        data = bytearray(f.read())
+    struct.pack_into('>H', data, 6, pgen.VERSION + 1)
+    stale = tmp_path / 'stale.pack'
+    stale.write_bytes(bytes(data))
+    with pytest.raises(texPack.PackError):
+        texPack.TexturePack(str(stale))
+
+def test_truncatedPackIsRejected(pack, tmp_path):
+    with open(pack.fileName, 'rb') as f:
+        data = f.read()
+    truncated = tmp_path / 'truncated.pack'
+    truncated.write_bytes(data[:-1])
+    with pytest.raises(texPack.PackError):
+        texPack.TexturePack(str(truncated))
+
+def test_emptyFileIsRejected(tmp_path):
+    empty = tmp_path / 'empty.pack'
+    empty.write_bytes(b'')
+    with pytest.raises(texPack.PackError):
+        texPack.TexturePack(str(empty))
+
+def test_truncatedIndexIsRejected(pack, tmp_path):
+    with open(pack.fileName, 'rb') as f:
+        data = f.read()
+    truncated = tmp_path / 'truncated.pack'
+    truncated.write_bytes(data[:texPack.HEADER.size + 1])
+    with pytest.raises(texPack.PackError):
+        texPack.TexturePack(str(truncated))
+
+def test_packOfTheOtherLandModeIsRejected(pack, monkeypatch):
+    monkeypatch.setattr(pgen, 'RECOLOUR_LANDS', not pgen.RECOLOUR_LANDS)
+    with pytest.raises(texPack.PackError):
+        texPack.TexturePack(pack.fileName)
+
+def test_rejectedPackIsUnmapped(pack, monkeypatch):
+    maps = []
+    class Mmap(texPack.mmap.mmap):
+        def __init__(self, *args, **kwargs):
+            maps.append(self)
+    monkeypatch.setattr(texPack.mmap, 'mmap', Mmap)
+    monkeypatch.setattr(pgen, 'VERSION', pgen.VERSION + 1)
+    with pytest.raises(texPack.PackError):
+        texPack.TexturePack(pack.fileName)
+    assert len(maps) == 1 and maps[0].closed
@@ -0,0 +1,132 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import pygame.image as pgi
+
+# next to this file, wherever the game is run from
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "texCache")
+EXTENSION = ".rgba"
+MEMORY_LIMIT = 2 ** 26 # bytes of textures kept in memory
+DISK_LIMIT = 2 ** 28 # bytes of textures kept on disk
+HEADERSIZE = 4
+B_ORDER = 'big'
+
+class TextureCache():
+    """Least recently used cache of generated textures, kept both in memory
+    and on disk. Keys are tuples of everything the texture was generated
+    from. The cache keeps its own copies of the textures, so the surfaces
+    given to it and got from it can be drawn on."""
+
+    def __init__(self, directory=DIRECTORY, memoryLimit=MEMORY_LIMIT,
+                 diskLimit=DISK_LIMIT):
+        self.directory = directory
+        self.memoryLimit = memoryLimit
+        self.diskLimit = diskLimit
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memoryUsed = 0
+        self.diskUsed = None # scanned the first time the disk is used
+
+    def fileName(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest + EXTENSION)
+
+    def get(self, key):
+        """Returns the texture stored under key, or None."""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key].copy()
+        sf = self.load(key)
+        if sf is None: return None
+        with self.lock: self.remember(key, sf)
+        return sf.copy()
+
+    def put(self, key, sf):
+        with self.lock:
+            self.remember(key, sf.copy())
+        self.save(key, sf)
+
+    def getOrMake(self, key, makeFn, *args):
+        """Returns the texture stored under key, making it with
+        makeFn(*args) first if it is not cached."""
+        sf = self.get(key)
+        if sf is None:
+            sf = makeFn(*args)
+            self.put(key, sf)
+        return sf
+
+    def remember(self, key, sf):
+        if key in self.memory:
+            self.memoryUsed -= textureSize(self.memory.pop(key))
+        self.memory[key] = sf
+        self.memoryUsed += textureSize(sf)
+        while self.memoryUsed > self.memoryLimit and len(self.memory) > 1:
+            oldKey, oldSf = self.memory.popitem(last=False)
+            self.memoryUsed -= textureSize(oldSf)
+
+    def load(self, key):
+        fileName = self.fileName(key)
+        try:
+            with open(fileName, 'rb') as f:
+                data = f.read()
+            # touch the file so that eviction sees it as recently used
+            os.utime(fileName)
+        except OSError: return None
+        w = int.from_bytes(data[:HEADERSIZE // 2], B_ORDER)
+        h = int.from_bytes(data[HEADERSIZE // 2:HEADERSIZE], B_ORDER)
+        if len(data) != HEADERSIZE + w * h * 4: return None
+        return pgi.fromstring(data[HEADERSIZE:], (w, h), 'RGBA')
+
+    def save(self, key, sf):
+        w, h = sf.get_size()
+        data = (w.to_bytes(HEADERSIZE // 2, B_ORDER) +
+                h.to_bytes(HEADERSIZE // 2, B_ORDER) +
+                pgi.tostring(sf, 'RGBA'))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with self.lock:
+                if self.diskUsed is None:
+                    self.diskUsed = sum(size for name, size, t in
+                                        self.diskEntries())
+                fileName = self.fileName(key)
+                if os.path.exists(fileName):
+                    self.diskUsed -= os.path.getsize(fileName)
+                with open(fileName, 'wb') as f:
+                    f.write(data)
+                self.diskUsed += len(data)
+                if self.diskUsed > self.diskLimit:
+                    self.evictDisk()
+        except OSError:
+            print("Unable to write to texture cache.")
+
+    def diskEntries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(EXTENSION): continue
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((name, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evictDisk(self):
+        # remove the least recently used files down to 3/4 of the limit
+        for name, size, t in sorted(self.diskEntries(), key=lambda e: e[2]):
+            if self.diskUsed <= self.diskLimit * 3 // 4: break
+            os.remove(os.path.join(self.directory, name))
+            self.diskUsed -= size
+
+def textureSize(sf):
+    w, h = sf.get_size()
+    return w * h * sf.get_bytesize()
+
+CACHE = None
+
+def getCache():
+    """Returns the cache shared by the whole program."""
+    global CACHE
+    if CACHE is None:
+        CACHE = TextureCache()
+    return CACHE
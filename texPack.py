@@ -0,0 +1,162 @@
+"""Pre-baked planet texture packs.
+
+A pack is made offline with
+
+    python texPack.py planets.pack --radii 20 40 --count 50
+
+and holds finished planet images for a range of radii, all with the same
+shine and fade. The file is a header, an index with the radius, style and
+seed of every image, and then the raw RGBA pixels of the images one after
+the other. Packs are memory mapped, so an image is only read from the disk
+when it is picked. A pack only loads with the pgen version and land mode
+(pgen.RECOLOUR_LANDS) it was made with.
+"""
+import os
+import sys
+import mmap
+import struct
+import argparse
+from concurrent import futures
+
+import pygame as pg
+
+import pgen
+
+MAGIC = b'GPTP'
+FORMAT = 2
+# magic, format, pgen version, number of images, shine x, shine y, fade,
+# whether land planets were recoloured
+HEADER = struct.Struct('>4sHHIddd?')
+# radius, style, seed, offset of the pixels from the start of the file
+ENTRY = struct.Struct('>HBxIQ')
+STYLES = ('random', 'solid', 'bands', 'land')
+
+class PackError(Exception):
+    pass
+
+class TexturePack():
+    """Read-only view of a texture pack file. Each image picked gets its own
+    copy of its pixels, so it can be drawn on like any other surface."""
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, 'rb') as f:
+            # an empty file cannot be mapped
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise PackError("%s is too short to be a texture pack" %
+                                fileName)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.readIndex()
+        except Exception:
+            self.data.close()
+            raise
+
+    def readIndex(self):
+        (magic, fmt, self.version, count, self.shineX, self.shineY,
+         self.fade, self.recolourLands) = HEADER.unpack_from(self.data)
+        if magic != MAGIC or fmt != FORMAT:
+            raise PackError("%s is not a texture pack" % self.fileName)
+        if self.version != pgen.VERSION:
+            raise PackError("%s was made by pgen version %d, not %d; rebuild "
+                            "it" % (self.fileName, self.version, pgen.VERSION))
+        if self.recolourLands != pgen.RECOLOUR_LANDS:
+            raise PackError("%s was made with RECOLOUR_LANDS %s; rebuild it" %
+                            (self.fileName, self.recolourLands))
+        if HEADER.size + count * ENTRY.size > len(self.data):
+            raise PackError("%s is truncated" % self.fileName)
+        self.entries = dict() # radius: [(style, seed, offset)]
+        for i in range(count):
+            r, style, seed, offset = ENTRY.unpack_from(
+                self.data, HEADER.size + i * ENTRY.size)
+            if offset + imageSize(r) > len(self.data):
+                raise PackError("%s is truncated" % self.fileName)
+            self.entries.setdefault(r, []).append((STYLES[style], seed,
+                                                   offset))
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+    def radii(self):
+        return sorted(self.entries)
+
+    def image(self, r, offset):
+        w = r * 2 + 1
+        return pg.image.fromstring(self.data[offset:offset + imageSize(r)],
+                                   (w, w), 'RGBA')
+
+    def pick(self, r, seed):
+        """Picks an image of radius r for the given seed. Returns the seed
+        and style it was made with and the image, or None if the pack has no
+        images of that radius."""
+        if r not in self.entries: return None
+        entries = self.entries[r]
+        style, packSeed, offset = entries[seed % len(entries)]
+        return packSeed, style, self.image(r, offset)
+
+def imageSize(r):
+    return (r * 2 + 1) ** 2 * 4
+
+def buildPack(fileName, radii, count, style=None, seed=0, shineX=0.,
+              shineY=0., fade=0.8, workers=None):
+    """Makes count planets of each radius in radii and writes them to a pack.
+    The seed of the i-th planet is pgen.planetSeed(seed, i). Land planets
+    are made in the mode pgen.RECOLOUR_LANDS is in."""
+    jobs = []
+    for r in radii:
+        for i in range(count):
+            jobs.append((r, pgen.planetSeed(seed, len(jobs)), shineX, shineY,
+                         fade, style, pgen.RECOLOUR_LANDS))
+    styleNo = STYLES.index('random' if style is None else style)
+
+    offset = HEADER.size + ENTRY.size * len(jobs)
+    with open(fileName, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT, pgen.VERSION, len(jobs), shineX,
+                            shineY, fade, pgen.RECOLOUR_LANDS))
+        for job in jobs:
+            r, planetSeed = job[:2]
+            f.write(ENTRY.pack(r, styleNo, planetSeed, offset))
+            offset += imageSize(r)
+        with futures.ProcessPoolExecutor(workers) as pool:
+            for buf in pool.map(pgen.genPlanetBuffer, jobs, chunksize=16):
+                f.write(buf)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Makes a pack of pre-baked planet textures.")
+    parser.add_argument('fileName')
+    parser.add_argument('--radii', type=int, nargs=2, default=(20, 40),
+                        metavar=('MIN', 'MAX'))
+    parser.add_argument('--count', type=int, default=20,
+                        help="planets of each radius")
+    parser.add_argument('--style', choices=STYLES[1:])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shine', type=float, nargs=2, default=(0.1, -0.1),
+                        metavar=('X', 'Y'))
+    parser.add_argument('--fade', type=float, default=0.8)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    rMin, rMax = args.radii
+    buildPack(args.fileName, range(rMin, rMax + 1), args.count, args.style,
+              args.seed, args.shine[0], args.shine[1], args.fade,
+              args.workers)
+    pack = TexturePack(args.fileName)
+    print("Wrote %d planets to %s (%d bytes)." %
+          (len(pack), args.fileName, os.path.getsize(args.fileName)))
+    return 0
+
+PATH = None # pack used for map generation, or None to generate planets
+PACK = None
+
+def getPack():
+    """Returns the pack at PATH, opened once for the whole program, or None
+    when there is no pack to use."""
+    global PACK
+    if PATH is None: return None
+    if PACK is None or PACK.fileName != PATH:
+        PACK = TexturePack(PATH)
+    return PACK
+
+if __name__ == "__main__":
+    sys.exit(main())